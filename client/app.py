@@ -1,22 +1,21 @@
 import sys
+import logging
 
 from PyQt5.QtWidgets import QApplication, QMainWindow, QMenu, QToolBar, QSizePolicy, QToolButton, QAction, QHBoxLayout, QWidget, QLabel
-from PyQt5.QtCore import Qt, QCoreApplication, QTimeLine
+from PyQt5.QtCore import Qt, QCoreApplication, QTimeLine, QTimer
 from PyQt5.QtGui import QIcon, QFontMetrics
 from pypref import Preferences
 
-from gtts import gTTS
-
-import requests
 import pygame
-import time
-import io
 
 from def_utilities import local_file, read_json, make_icon
+from def_http import HttpSession
 from def_windows import LoginWindow, UserWindow, PasswordWindow
 from def_websocket import WebSocket
-
-pygame.mixer.init()
+from def_tts import AudioCache
+from def_alerts import AlertPresenter, WHITE_TEXT
+from def_sounds import SoundBank
+from def_roster import RosterModel, RosterPopup
 
 # Define the main alert bar
 class AlertWindow(QMainWindow):
@@ -26,14 +25,32 @@ class AlertWindow(QMainWindow):
         self.SERVER_URL = self.config.get("SERVER_URL")
         self.user = Preferences(filename="manifest_cache.py")
         self.alerts = None
+        # Kept-alive HTTP connection to the server, requests run off the GUI thread
+        self.http = HttpSession(self.SERVER_URL, self.config.get("HTTP", {}))
+        # Server rendered speech, fetched once per alert text
+        self.audio_cache = AudioCache(self, self.config.get("TTS_CACHE", {}))
         self.init_ui()
-
-        self.ws = WebSocket(self)
+        # Alerts are queued and shown one at a time, sounds and flashing never block the GUI thread
+        # Klaxons decoded once, on their own mixer channels
+        self.sounds = SoundBank(self.config.get("SOUNDS", {}))
+        self.presenter = AlertPresenter(self, self.sounds, self.audio_cache, self.config.get("ALERTS", {}))
+        # Newest alert seen, written to the preferences file at most once per delay
+        # instead of on every live alert
+        self.alert_seq = None
+        self.alert_seq_timer = QTimer(self)
+        self.alert_seq_timer.setSingleShot(True)
+        self.alert_seq_timer.setInterval(int(self.config.get("ALERTS", {}).get("seq_save_delay", 5) * 1000))
+        self.alert_seq_timer.timeout.connect(self.write_alert_seq)
+
+        self.ws = WebSocket(self, self.config.get("RECONNECT", {}))
         self.ws.password_changed.connect(self.password_changed)
         self.ws.load_users.connect(self.populate_users)
+        self.ws.user_joined.connect(self.add_user)
+        self.ws.user_left.connect(self.remove_user)
         self.ws.load_alerts.connect(self.populate_alerts)
-        self.ws.audio_alert.connect(self.audio_alert)
         self.ws.display_alert.connect(self.display_alert)
+        self.ws.show_alert.connect(self.show_alert)
+        self.ws.alert_seen.connect(self.save_alert_seq)
         self.ws.disconnected.connect(self.websocket_disconnected)
         self.ws.connected.connect(self.websocket_connected)
         self.ws.logout.connect(self.logout)
@@ -41,6 +58,7 @@ class AlertWindow(QMainWindow):
         self.user_window = UserWindow(self)
         self.login_window = LoginWindow(self)
         self.password_window = PasswordWindow(self)
+        self.ws.login_result.connect(self.login_window.login_done)
 
     def init_ui(self):
         self.title = "Alert App"
@@ -98,8 +116,10 @@ class AlertWindow(QMainWindow):
         self.control_users = QToolButton(self.toolbar_container)
         self.control_users.setText('Users')
         self.control_users.setStyleSheet("QToolButton { padding:0.5em; } QToolButton::menu-indicator { width:0; height:0; }")
-        self.control_users.setPopupMode(QToolButton.InstantPopup)
         self.toolbar_layout.addWidget(self.control_users)
+        self.roster = RosterModel(self)
+        self.roster_popup = RosterPopup(self.roster, self)
+        self.control_users.clicked.connect(lambda checked: self.roster_popup.show_below(self.control_users))
 
         self.control_alerts = QToolButton(self.toolbar_container)
         self.control_alerts.setText('Alerts')
@@ -127,7 +147,7 @@ class AlertWindow(QMainWindow):
             self.control_options.setText(self.user.get("username"))
             self.display_alert("Connecting to mothership ...","lightgrey")
             if not self.ws.isConnected():
-                self.ws.connect()
+                self.ws.connect_async()
         else:
             self.control_options_settings.setText("Login")
             self.control_options_settings.setIcon(make_icon("login"))
@@ -135,8 +155,7 @@ class AlertWindow(QMainWindow):
             self.control_options_logout.setVisible(False)
             self.display_alert("Please login ...","lightgrey")
             self.control_options.setText("Login")               
-            if self.ws.isConnected():
-                self.ws.disconnect()
+            self.ws.disconnect()
 
     def websocket_connected(self):
         self.control_options_password.setVisible(True)
@@ -148,18 +167,21 @@ class AlertWindow(QMainWindow):
             self.control_alerts.show()
 
     def websocket_disconnected(self):
+        # The next connect sends the saved seq
+        self.write_alert_seq()
         self.control_options_password.setVisible(False)
         self.control_options_websocket.setText("Connect")
         self.control_options_websocket.setIcon(make_icon("disconnected"))
         self.display_alert("Disconnected!", "orange")
         self.control_users.hide()
+        self.roster_popup.hide()
         self.control_alerts.hide()
 
     def websocket_toggler(self):
         if self.ws.isConnected():
             self.ws.disconnect()
         else:
-            self.ws.connect()
+            self.ws.connect_async()
         QCoreApplication.processEvents()
 
 
@@ -181,9 +203,9 @@ class AlertWindow(QMainWindow):
         QCoreApplication.processEvents()
 
     # Only disconnect from websocket - user session persists 
+    # Also stops a reconnect in progress
     def disconnect(self):
-        if self.ws.isConnected():
-            self.ws.disconnect()
+        self.ws.disconnect()
 
     # Disconnect from websocket and then flush user from client and server
     def logout(self):
@@ -193,7 +215,8 @@ class AlertWindow(QMainWindow):
 
         self.disconnect()
         if self.user.get("token") is not None:
-            requests.post(f"{self.SERVER_URL}/logout", data={"token": self.user.get("token")})
+            # Nothing to wait for, the local session is dropped either way
+            self.http.post("/logout", {"token": self.user.get("token")})
         reset = { "token":None, "role":None, "username":None }
         self.user.update_preferences(reset)
         self.update_ui()
@@ -210,35 +233,39 @@ class AlertWindow(QMainWindow):
         # Change the opacity of the Alert window
         self.volume = value / 100
 
-    def send_alert(self, text, color):
+    def send_alert(self, text, color, audience=None):
         # If token is allowed, message will be broadcast
+        # NOTE: With an audience only those roles/groups (and the sender) receive it
         data = {  
             "token": self.user.get("token"),
             "text": text,
             "color": color
         }
+        if audience:
+            data["audience"] = audience
         # Send data t server
         if self.user.get("token") and self.ws.isConnected():
             self.ws.send_alert(data)
 
+    # Full roster snapshot, keyed by connection id
     def populate_users(self, users):
-        menu = QMenu()
-        for user in users:
-            name = user['name']
-            color = 'lightgreen'
-            if 'color' in user and user['color']:
-                color = user['color']
-
-            icon = make_icon('spock-fill', color)
-            if 'icon' in user and user["icon"]:
-                icon = make_icon(user["icon"], color)
-    
-            action = QAction(icon, name, menu)
-            menu.addAction(action)
-        self.control_users.setText('Users ('+str(len(users))+')')
-        self.control_users.setMenu(menu)
+        self.roster.reset(users)
+        self.update_user_count()
+
+    # Roster delta - add or replace one user
+    def add_user(self, id, user):
+        self.roster.upsert(id, user)
+        self.update_user_count()
+
+    # Roster delta - remove one user
+    def remove_user(self, id):
+        self.roster.remove(id)
+        self.update_user_count()
+
+    def update_user_count(self):
+        self.control_users.setText('Users ('+str(self.roster.rowCount())+')')
 
-    def populate_alerts(self, alerts):
+    def populate_alerts(self, alerts, version):
         if self.alerts is not None:
             return
         
@@ -246,7 +273,11 @@ class AlertWindow(QMainWindow):
             return e.get("sort_index")
         
         self.alerts = alerts
-        self.alerts.sort(key=sort_index)
+        if version:
+            # Versioned catalogs come sorted, keep a copy for the next connect
+            self.user.update_preferences({ "alerts":alerts, "alerts_version":version })
+        else:
+            self.alerts.sort(key=sort_index)
         menu = QMenu()
         for alert in self.alerts:
             text = alert["text"]
@@ -255,7 +286,7 @@ class AlertWindow(QMainWindow):
             action = QAction(icon, text, menu)
             if alert["shortcut"]:
                 action.setShortcut(alert["shortcut"])  
-            action.triggered.connect(lambda checked, t=text, c=color: self.send_alert(t,c))
+            action.triggered.connect(lambda checked, t=text, c=color, a=alert.get("audience"): self.send_alert(t,c,a))
             menu.addAction(action)
 
         self.control_alerts.setMenu(menu)
@@ -297,63 +328,50 @@ class AlertWindow(QMainWindow):
         string = '{} pressed'.format(text)
         self.alert_label.setText(string)
         
-    # Flash the background color by changing opacity from nothing to everything
-    def flash(self, cycles, flash_time):
-        for n in range(cycles):
-            self.change_opacity(1)
-            time.sleep(flash_time/2)
-            self.change_opacity(100)
-            time.sleep(flash_time/2)
-        value = self.user_window.opacity_slider.value()
-        self.change_opacity(value)
-
     def setTextColor(self,color): 
         self.alert_label.setStyleSheet("padding:0.5em 1em; color: "+color+";")
         self.control_options.setStyleSheet("QToolButton { color: "+color+"; padding:0.5em; } QToolButton::menu-indicator { width:0; height:0; }")
         self.control_users.setStyleSheet("QToolButton { color: "+color+"; padding:0.5em; } QToolButton::menu-indicator { width:0; height:0; }")
         self.control_alerts.setStyleSheet("QToolButton { color: "+color+"; padding:0.5em; } QToolButton::menu-indicator { width:0; height:0; }")
-        QCoreApplication.processEvents()
 
-    def audio_alert(self, user, message):
-        tts = gTTS("From "+user+". "+message, lang='en')
-        audio = io.BytesIO()
-        tts.write_to_fp(audio)
-        audio.seek(0)
-        sound = pygame.mixer.Sound(audio)
-        volume = self.user_window.volume_slider.value()
-        sound.set_volume(volume/100)
-        sound.play()
-        
+    def volume(self):
+        return self.user_window.volume_slider.value() / 100
+
+    # Queue a server alert, sequenced alerts are acknowledged as soon as they are on screen
+    def show_alert(self, alert):
+        seq = alert.get("seq")
+        if seq is not None:
+            received = alert.get("received")
+            alert["on_shown"] = lambda audio_delay: self.ws.ack_alert(seq, received, audio_delay)
+        self.presenter.submit(alert)
+
+    # Remember the newest alert seen, sent on the next connect to replay what was missed
+    def save_alert_seq(self, seq, replace):
+        last_seq = self.alert_seq if self.alert_seq is not None else self.user.get("last_seq")
+        if replace or last_seq is None or seq > last_seq:
+            self.alert_seq = seq
+            if not self.alert_seq_timer.isActive():
+                self.alert_seq_timer.start()
+
+    # Write the remembered seq out, when the timer fires and on disconnect or exit
+    def write_alert_seq(self):
+        self.alert_seq_timer.stop()
+        if self.alert_seq is not None:
+            self.user.update_preferences({ "last_seq":self.alert_seq })
+            self.alert_seq = None
+
+    # Local status messages go through the same queue, behind any alert still playing
     def display_alert(self, text, color):
+        self.presenter.submit({ "text":text, "color":color })
+
+    # Put an alert on the bar, called by the presenter
+    def paint_alert(self, text, color):
         self.alert_label.setText(text)
         self.toolbar.setStyleSheet("background:"+color+";")
-        self.setTextColor("black")
-        QCoreApplication.processEvents()
-
-        klaxon = None
-
-        if color == "lightgreen":
-            klaxon = pygame.mixer.Sound(local_file('green_alarm.mp3'))
-        if color == "blue":
-            klaxon = pygame.mixer.Sound(local_file('blue_alarm.mp3'))
-            self.setTextColor("white")
-        if color == "purple":
-            klaxon = pygame.mixer.Sound(local_file('purple_alarm.mp3'))
-            self.setTextColor("white")
-        elif color == "yellow":
-            klaxon = pygame.mixer.Sound(local_file('yellow_alarm.mp3'))
-        elif color == "red":
+        self.setTextColor("white" if color in WHITE_TEXT else "black")
+        # Everything but purple and yellow scrolls, as it always has
+        if color not in ("purple", "yellow"):
             self.feed(text)
-            klaxon = pygame.mixer.Sound(local_file('red_alarm.mp3'))
-            self.setTextColor("white")
-        else:
-            self.feed(text)
-
-        if klaxon:
-            volume = self.user_window.volume_slider.value()
-            klaxon.set_volume(volume/100)
-            klaxon.play()     
-            self.flash(4, 0.5)
             
     def closeEvent(self, event):
         self.exit()
@@ -361,13 +379,18 @@ class AlertWindow(QMainWindow):
 
     # Disconnect and exit application - user session persists
     def exit(self):
+        self.write_alert_seq()
+        self.presenter.close()
         pygame.mixer.quit()
         self.disconnect()
+        self.http.close()
         QCoreApplication.quit()
         quit()
 
 # Initialize the app
 def main():
+    # Load failures (e.g. a missing klaxon file) go to stderr with a timestamp
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     app = QApplication(sys.argv)
     alert_display = AlertWindow()
     alert_display.show()
@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWidgets import QApplication, QMenu, QAction
+
+import def_utilities
+from def_utilities import ICONS, make_icon, svg_to_pixmap
+
+# Benchmark: refreshing a large roster menu
+# Rebuilds a menu of users (one icon each, a handful of colours) the way
+# populate_users does, once building every icon from scratch like make_icon
+# used to and once through the icon cache, so the saving per refresh is visible
+#
+# Usage: python bench_icons.py [users] [refreshes]
+
+COLORS = ["lightgreen", "red", "purple", "blue", "yellow", "orange", "white", "gray"]
+
+# make_icon before the cache - SVG rebuilt with the colour and parsed every call
+def uncached_icon(name, color):
+    svg_data = ICONS[name].replace('fill="black"', 'fill="'+color+'"')
+    def_utilities.renderers.clear()
+    return QIcon(svg_to_pixmap(svg_data, 24))
+
+def roster(users):
+    return [
+        { "name":"user"+str(n), "color":COLORS[n % len(COLORS)], "icon":"spock-fill" }
+        for n in range(users)
+    ]
+
+def refresh(menu, users, icon_for):
+    menu.clear()
+    for user in users:
+        menu.addAction(QAction(icon_for(user["icon"], user["color"]), user["name"], menu))
+
+def timed(name, refreshes, menu, users, icon_for):
+    started = time.perf_counter()
+    for n in range(refreshes):
+        refresh(menu, users, icon_for)
+    elapsed = (time.perf_counter() - started) / refreshes * 1000
+    print(f"{name:>10}: {elapsed:8.2f}ms per refresh")
+    return elapsed
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    refreshes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    app = QApplication(sys.argv)
+    menu = QMenu()
+    users = roster(count)
+
+    print(f"{count} users, {refreshes} refreshes")
+    uncached = timed("uncached", refreshes, menu, users, uncached_icon)
+    def_utilities.icon_cache.clear()
+    cold = timed("cold", 1, menu, users, make_icon)
+    cached = timed("cached", refreshes, menu, users, make_icon)
+    print(f"{'speedup':>10}: {uncached / cached:8.1f}x")
@@ -0,0 +1,196 @@
+import io
+import time
+import heapq
+import queue
+import itertools
+
+import pygame
+
+from gtts import gTTS
+from PyQt5.QtCore import QObject, QThread, QTimer, QPropertyAnimation, pyqtSignal
+
+# Alert presentation without blocking the GUI thread
+# Alerts are shown one at a time from a queue ordered by colour, the flash is
+# a QPropertyAnimation, speech is fetched/synthesized and decoded on worker
+# threads, and a QTimer notices when the sounds have finished. A more urgent
+# alert (red over green, ...) cuts the one on screen short.
+
+# Lower number is more urgent
+PRIORITIES = { "red":0, "purple":1, "blue":2, "yellow":3, "lightgreen":4 }
+LOWEST_PRIORITY = 5
+WHITE_TEXT = ("red", "purple", "blue")
+
+def priority(color):
+    return PRIORITIES.get(color, LOWEST_PRIORITY)
+
+# Speech for alerts, fetched or synthesized and decoded off the GUI thread
+# Jobs are taken most urgent first, so a red alert's speech isn't stuck
+# behind a green one still rendering
+class SpeechWorker(QThread):
+    ready = pyqtSignal(int, object)
+
+    def __init__(self, jobs, audio_cache):
+        super().__init__()
+        self.jobs = jobs
+        self.audio_cache = audio_cache
+
+    def run(self):
+        while True:
+            urgency, order, job = self.jobs.get()
+            if job is None:
+                return
+            alert_id, text, key = job
+            try:
+                sound = pygame.mixer.Sound(io.BytesIO(self.render(text, key)))
+            except Exception:
+                sound = None
+            self.ready.emit(alert_id, sound)
+
+    def render(self, text, key):
+        audio = self.audio_cache.get(key) if key else None
+        if audio is None:
+            # Server doesn't render speech (or couldn't), synthesize it here
+            output = io.BytesIO()
+            gTTS(text, lang='en').write_to_fp(output)
+            audio = output.getvalue()
+        return audio
+
+class AlertPresenter(QObject):
+    def __init__(self, window, sounds, audio_cache, options):
+        super().__init__()
+        self.window = window
+        self.sounds = sounds
+        self.queue_size = options.get("queue_size", 20)
+        self.flash_cycles = options.get("flash_cycles", 4)
+        self.flash_time = options.get("flash_time", 0.5)
+        # Longest an alert waits for its speech before the next one is shown
+        self.speech_timeout = options.get("speech_timeout", 15)
+        self.ids = itertools.count(1)
+        self.order = itertools.count()
+        self.pending = []
+        self.current = None
+        self.channels = []
+
+        self.flash = QPropertyAnimation(window, b"windowOpacity")
+        self.flash.setDuration(int(self.flash_time * 1000))
+        self.flash.setKeyValueAt(0, 0.1)
+        self.flash.setKeyValueAt(0.5, 1.0)
+        self.flash.setKeyValueAt(1, 0.1)
+        self.flash.finished.connect(self.restore_opacity)
+
+        # Checks whether the alert on screen is done
+        self.poll = QTimer(self)
+        self.poll.setInterval(100)
+        self.poll.timeout.connect(self.check_done)
+        self.speech_wait = QTimer(self)
+        self.speech_wait.setSingleShot(True)
+        self.speech_wait.timeout.connect(self.speech_timed_out)
+
+        self.jobs = queue.PriorityQueue()
+        self.workers = [SpeechWorker(self.jobs, audio_cache) for n in range(options.get("speech_workers", 2))]
+        for worker in self.workers:
+            worker.ready.connect(self.speech_ready)
+            worker.start()
+
+    # alert: text, color, and optionally speech, audio (server speech key),
+    # quiet (no klaxon or flash), received (time.monotonic() it arrived) and
+    # on_shown(audio_delay) - audio_delay is received to first klaxon sample
+    def submit(self, alert):
+        alert["id"] = next(self.ids)
+        alert["priority"] = priority(alert.get("color"))
+        if self.current is None:
+            self.present(alert)
+        elif alert["priority"] < self.current["priority"]:
+            # More urgent, cut the current alert short and show it again afterwards
+            interrupted = self.current
+            self.stop()
+            # Already acknowledged when it was first shown
+            interrupted["on_shown"] = None
+            self.queue(interrupted)
+            self.present(alert)
+        else:
+            self.queue(alert)
+
+    def queue(self, alert):
+        heapq.heappush(self.pending, (alert["priority"], next(self.order), alert))
+        if len(self.pending) > self.queue_size:
+            # Drop the least urgent, newest alert
+            self.pending.remove(max(self.pending))
+            heapq.heapify(self.pending)
+
+    def present(self, alert):
+        self.current = alert
+        self.window.paint_alert(alert.get("text"), alert.get("color"))
+
+        audio_delay = None
+        klaxon = None if alert.get("quiet") else self.sounds.klaxon(alert.get("color"))
+        if klaxon is not None:
+            self.channels.append(self.sounds.play_klaxon(klaxon, self.window.volume()))
+            if alert.get("received") is not None:
+                audio_delay = time.monotonic() - alert["received"] + self.sounds.output_delay()
+            self.flash.setLoopCount(self.flash_cycles)
+            self.flash.start()
+
+        if alert.get("on_shown") is not None:
+            alert["on_shown"](audio_delay)
+
+        alert["speaking"] = bool(alert.get("speech"))
+        if alert["speaking"]:
+            self.jobs.put((alert["priority"], next(self.order), (alert["id"], alert["speech"], alert.get("audio"))))
+            self.speech_wait.start(int(self.speech_timeout * 1000))
+        self.poll.start()
+
+    def speech_ready(self, alert_id, sound):
+        if self.current is None or self.current["id"] != alert_id:
+            # Alert was cut short or timed out
+            return
+        self.current["speaking"] = False
+        self.speech_wait.stop()
+        if sound is not None:
+            channel = self.sounds.play(sound, self.window.volume())
+            if channel is not None:
+                self.channels.append(channel)
+
+    def speech_timed_out(self):
+        if self.current is not None:
+            self.current["speaking"] = False
+
+    def check_done(self):
+        if self.current is None:
+            self.poll.stop()
+            return
+        if self.current["speaking"] or self.flash.state() == QPropertyAnimation.Running:
+            return
+        if any(channel.get_busy() for channel in self.channels):
+            return
+        self.finish()
+
+    def finish(self):
+        self.poll.stop()
+        self.channels = []
+        self.current = None
+        if self.pending:
+            urgency, order, alert = heapq.heappop(self.pending)
+            self.present(alert)
+
+    def stop(self):
+        self.poll.stop()
+        self.speech_wait.stop()
+        for channel in self.channels:
+            channel.stop()
+        self.channels = []
+        if self.flash.state() == QPropertyAnimation.Running:
+            self.flash.stop()
+            self.restore_opacity()
+        self.current = None
+
+    def restore_opacity(self):
+        value = self.window.user_window.opacity_slider.value()
+        self.window.change_opacity(value)
+
+    def close(self):
+        self.stop()
+        for worker in self.workers:
+            self.jobs.put((-1, next(self.order), None))
+        for worker in self.workers:
+            worker.wait(1000)
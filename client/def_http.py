@@ -0,0 +1,98 @@
+import queue
+import itertools
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+
+# HTTP to the server over one kept-alive session
+# Connections are reused between requests instead of a new TCP/TLS handshake
+# each time, every request has a timeout, and failed connects are retried
+# with exponential backoff. Nothing is retried once the request was sent, a
+# POST could run twice and a 503 is the server asking for less. Calls made from
+# the GUI thread go through a worker thread and answer with a callback, so a
+# slow server never freezes the window.
+class HttpWorker(QThread):
+    done = pyqtSignal(int, int, object)
+
+    def __init__(self, session, jobs):
+        super().__init__()
+        self.session = session
+        self.jobs = jobs
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            request_id, method, path, kwargs = job
+            try:
+                response = self.session.request(method, path, **kwargs)
+                status = response.status_code
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = None
+            except requests.RequestException:
+                # No answer at all, reported as status 0
+                status = 0
+                body = None
+            self.done.emit(request_id, status, body)
+
+class HttpSession(QObject):
+    def __init__(self, server_url, options):
+        super().__init__()
+        self.server_url = server_url
+        self.timeout = options.get("timeout", 10)
+        retries = Retry(
+            total=options.get("retries", 3),
+            connect=options.get("retries", 3),
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=options.get("backoff", 0.5),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retries, pool_maxsize=options.get("connections", 4))
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.ids = itertools.count(1)
+        self.callbacks = {}
+        self.jobs = queue.Queue()
+        self.worker = HttpWorker(self, self.jobs)
+        self.worker.done.connect(self.finished)
+        self.worker.start()
+
+    # Blocking request, for worker threads
+    # Raises requests.RequestException when the server can't be reached
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, self.server_url + path, **kwargs)
+
+    # Request on the worker thread, callback(status, body) runs on the GUI thread
+    # status is 0 when the server couldn't be reached, body is the decoded JSON or None
+    def post(self, path, data, callback=None):
+        self.submit("POST", path, callback, data=data)
+
+    def get(self, path, params=None, callback=None):
+        self.submit("GET", path, callback, params=params)
+
+    def submit(self, method, path, callback, **kwargs):
+        request_id = next(self.ids)
+        if callback is not None:
+            self.callbacks[request_id] = callback
+        self.jobs.put((request_id, method, path, kwargs))
+
+    def finished(self, request_id, status, body):
+        callback = self.callbacks.pop(request_id, None)
+        if callback is not None:
+            callback(status, body)
+
+    def close(self):
+        self.jobs.put(None)
+        self.worker.wait(1000)
+        self.session.close()
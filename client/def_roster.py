@@ -0,0 +1,199 @@
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLineEdit, QComboBox, QListView
+from PyQt5.QtCore import Qt, QAbstractListModel, QSortFilterProxyModel, QModelIndex, pyqtSignal
+
+from def_utilities import make_icon
+
+# Online users as a list model behind a searchable popup
+# Roster deltas insert, change or remove single rows, so a join or leave
+# costs one row update instead of rebuilding a menu of every user. The view
+# only asks for rows it is showing, icons included, so a large roster is
+# never laid out or rendered in full.
+
+ROLE_ROLE = Qt.UserRole + 1
+GROUP_ROLE = Qt.UserRole + 2
+
+class RosterModel(QAbstractListModel):
+    roles_changed = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # Connection ids in row order, users by connection id
+        self.ids = []
+        self.rows = {}
+        self.users = {}
+        # Connections per role, for the role filter
+        self.role_counts = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.ids)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.ids):
+            return None
+        user = self.users[self.ids[index.row()]]
+        if role == Qt.DisplayRole:
+            return user.get("name")
+        if role == Qt.DecorationRole:
+            # Built when the row is first shown, shared through the icon cache
+            return make_icon(user.get("icon") or "spock-fill", user.get("color") or "lightgreen")
+        if role == Qt.ToolTipRole:
+            if user.get("group"):
+                return user.get("name")+" ("+user.get("group")+")"
+            return user.get("name")
+        if role == ROLE_ROLE:
+            return user.get("role")
+        if role == GROUP_ROLE:
+            return user.get("group") or ""
+        return None
+
+    # Full roster snapshot, keyed by connection id
+    def reset(self, users):
+        self.beginResetModel()
+        self.ids = list(users.keys())
+        self.rows = { id:row for row, id in enumerate(self.ids) }
+        self.users = dict(users)
+        self.role_counts = {}
+        for user in self.users.values():
+            self.count_role(user.get("role"), 1)
+        self.endResetModel()
+        self.roles_changed.emit()
+
+    # Add or replace one user
+    def upsert(self, id, user):
+        row = self.rows.get(id)
+        if row is None:
+            row = len(self.ids)
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.ids.append(id)
+            self.rows[id] = row
+            self.users[id] = user
+            self.endInsertRows()
+            changed = self.count_role(user.get("role"), 1)
+        else:
+            previous = self.users[id]
+            self.users[id] = user
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+            changed = False
+            if previous.get("role") != user.get("role"):
+                changed = self.count_role(previous.get("role"), -1)
+                changed = self.count_role(user.get("role"), 1) or changed
+        if changed:
+            self.roles_changed.emit()
+
+    # Remove one user
+    def remove(self, id):
+        row = self.rows.get(id)
+        if row is None:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.ids[row]
+        del self.rows[id]
+        user = self.users.pop(id)
+        # Only the rows after the removed one move up
+        for moved in range(row, len(self.ids)):
+            self.rows[self.ids[moved]] = moved
+        self.endRemoveRows()
+        if self.count_role(user.get("role"), -1):
+            self.roles_changed.emit()
+
+    # Returns True when a role appeared or disappeared
+    def count_role(self, role, change):
+        if role is None:
+            return False
+        count = self.role_counts.get(role, 0) + change
+        if count > 0:
+            self.role_counts[role] = count
+            return count == change
+        self.role_counts.pop(role, None)
+        return True
+
+    def roles(self):
+        return sorted(self.role_counts.keys())
+
+# Rows matching the search text (name or group) and the selected role
+class RosterFilter(QSortFilterProxyModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.text = ""
+        self.role = None
+        self.setSortCaseSensitivity(Qt.CaseInsensitive)
+        self.setDynamicSortFilter(True)
+
+    def set_text(self, text):
+        self.text = text.strip().lower()
+        self.invalidateFilter()
+
+    def set_role(self, role):
+        self.role = role
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        index = self.sourceModel().index(source_row, 0, source_parent)
+        if self.role is not None and index.data(ROLE_ROLE) != self.role:
+            return False
+        if not self.text:
+            return True
+        name = index.data(Qt.DisplayRole) or ""
+        return self.text in name.lower() or self.text in index.data(GROUP_ROLE).lower()
+
+class RosterPopup(QWidget):
+    def __init__(self, model, parent=None):
+        super().__init__(parent, Qt.Popup)
+        self.model = model
+        self.setMinimumWidth(220)
+
+        self.search = QLineEdit(self)
+        self.search.setPlaceholderText("Search users ...")
+        self.search.setClearButtonEnabled(True)
+        self.role_filter = QComboBox(self)
+
+        self.proxy = RosterFilter(self)
+        self.proxy.setSourceModel(model)
+        self.proxy.sort(0)
+        self.search.textChanged.connect(self.proxy.set_text)
+        self.role_filter.currentIndexChanged.connect(self.select_role)
+        model.roles_changed.connect(self.update_roles)
+
+        self.view = QListView(self)
+        self.view.setModel(self.proxy)
+        # Rows are all the same height, the view skips measuring every one
+        self.view.setUniformItemSizes(True)
+        self.view.setEditTriggers(QListView.NoEditTriggers)
+        self.view.setSelectionMode(QListView.NoSelection)
+
+        filters = QHBoxLayout()
+        filters.addWidget(self.search)
+        filters.addWidget(self.role_filter)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(4,4,4,4)
+        layout.addLayout(filters)
+        layout.addWidget(self.view)
+        self.update_roles()
+
+    # Roles only come with the roster for admins, the filter is hidden for everyone else
+    def update_roles(self):
+        self.role_filter.setVisible(bool(self.model.roles()))
+        selected = self.proxy.role
+        self.role_filter.blockSignals(True)
+        self.role_filter.clear()
+        self.role_filter.addItem("All roles", None)
+        for role in self.model.roles():
+            self.role_filter.addItem("Role "+str(role), role)
+        index = 0 if selected is None else self.role_filter.findData(selected)
+        self.role_filter.setCurrentIndex(index if index >= 0 else 0)
+        self.role_filter.blockSignals(False)
+        if index < 0:
+            self.proxy.set_role(None)
+
+    def select_role(self, index):
+        self.proxy.set_role(self.role_filter.itemData(index))
+
+    # Drop down below a widget
+    def show_below(self, widget):
+        self.resize(self.width(), 400)
+        self.move(widget.mapToGlobal(widget.rect().bottomLeft()))
+        self.show()
+        self.search.setFocus()
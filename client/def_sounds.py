@@ -0,0 +1,91 @@
+import time
+import logging
+import threading
+
+import pygame
+
+from def_utilities import local_file
+
+log = logging.getLogger("sounds")
+
+DEFAULT_SOUNDS = {
+    "red":"red_alarm.mp3",
+    "purple":"purple_alarm.mp3",
+    "blue":"blue_alarm.mp3",
+    "yellow":"yellow_alarm.mp3",
+    "lightgreen":"green_alarm.mp3",
+}
+
+# Klaxons decoded once and kept in memory, plus the mixer channels they play on
+# Sounds are decoded on a background thread at startup (or on first use if
+# an alert beats it), so playing one is only handing a buffer to the mixer.
+# The first "klaxon_channels" channels are reserved for klaxons, speech
+# plays on the others, so a klaxon and the speech that follows it, or two
+# overlapping alerts, never take each other's channel.
+class SoundBank():
+    def __init__(self, options):
+        self.frequency = options.get("frequency", 44100)
+        self.buffer = options.get("buffer", 512)
+        self.channels = options.get("channels", 8)
+        self.klaxon_channels = options.get("klaxon_channels", 2)
+        self.files = dict(DEFAULT_SOUNDS)
+        self.files.update(options.get("sounds", {}))
+
+        pygame.mixer.init(frequency=self.frequency, buffer=self.buffer)
+        pygame.mixer.set_num_channels(self.channels)
+        pygame.mixer.set_reserved(self.klaxon_channels)
+        self.klaxon_pool = [pygame.mixer.Channel(n) for n in range(self.klaxon_channels)]
+        # When each klaxon channel last started a sound
+        self.started = [0] * self.klaxon_channels
+
+        self.lock = threading.Lock()
+        # Decoded klaxons by colour, None for ones that failed to load
+        self.sounds = {}
+        if options.get("preload", True):
+            threading.Thread(target=self.preload, name="sound-preload", daemon=True).start()
+
+    def preload(self):
+        for color in self.files:
+            self.klaxon(color)
+
+    # Decoded klaxon for a colour, None for colours without one or whose file
+    # couldn't be loaded (tried once, the alert is still shown without it)
+    def klaxon(self, color):
+        if color in self.sounds or color not in self.files:
+            return self.sounds.get(color)
+        with self.lock:
+            if color not in self.sounds:
+                try:
+                    self.sounds[color] = pygame.mixer.Sound(local_file(self.files[color]))
+                except (pygame.error, OSError) as e:
+                    log.error("Could not load the %s klaxon %s: %s", color, self.files[color], e)
+                    self.sounds[color] = None
+            return self.sounds[color]
+
+    # Play on an idle klaxon channel, or the one started longest ago
+    def play_klaxon(self, sound, volume):
+        index = None
+        for n, candidate in enumerate(self.klaxon_pool):
+            if not candidate.get_busy():
+                index = n
+                break
+        if index is None:
+            index = self.started.index(min(self.started))
+        channel = self.klaxon_pool[index]
+        self.started[index] = time.monotonic()
+        sound.set_volume(volume)
+        channel.play(sound)
+        return channel
+
+    # Speech and anything else, on an unreserved channel (the longest playing one if all are busy)
+    def play(self, sound, volume):
+        channel = pygame.mixer.find_channel(True)
+        if channel is None:
+            return None
+        sound.set_volume(volume)
+        channel.play(sound)
+        return channel
+
+    # Time the mixer takes to reach the first sample of a sound just started
+    def output_delay(self):
+        return self.buffer / self.frequency
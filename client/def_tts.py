@@ -0,0 +1,100 @@
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+import requests
+
+from def_utilities import local_file
+
+# Spoken alert audio fetched from the server by key and kept locally
+# Alerts carry the key of their audio, the same key always means the same
+# audio, so once fetched it is served from memory or the cache directory
+# and never requested again.
+class AudioCache():
+    def __init__(self, parent, options):
+        self.parent = parent
+        self.directory = local_file(options.get("dir", "tts_cache"))
+        self.entries = options.get("entries", 200)
+        self.timeout = options.get("timeout", 10)
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        # Key -> lock held while it is read or fetched, so each key is fetched once
+        self.loading = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    # Audio bytes for a key, None if the server couldn't provide them
+    def get(self, key):
+        # Keys are hex digests, anything else didn't come from the server
+        if not key.isalnum():
+            return None
+        with self.lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+                return audio
+            loading = self.loading.setdefault(key, threading.Lock())
+
+        # A second worker asking for the same key waits here, then finds the file
+        with loading:
+            path = self.path(key)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    audio = f.read()
+            else:
+                audio = self.fetch(key)
+                if audio is not None:
+                    self.store(path, audio)
+                    self.prune()
+            with self.lock:
+                self.loading.pop(key, None)
+                if audio is None:
+                    return None
+                self.memory[key] = audio
+                while len(self.memory) > self.entries:
+                    self.memory.popitem(last=False)
+        return audio
+
+    # Written to a temporary file and renamed, a crash mid-write never leaves a truncated file under the key
+    def store(self, path, audio):
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(audio)
+            os.replace(temp, path)
+        except OSError:
+            # Played from memory this time, fetched again next run
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+    def fetch(self, key):
+        try:
+            # Shares the client's kept-alive connection, called from a speech worker thread
+            response = self.parent.http.request(
+                "GET", "/tts/" + key,
+                headers={ "Authorization":"Bearer "+str(self.parent.user.get("token")) },
+                timeout=self.timeout
+            )
+        except requests.RequestException:
+            return None
+        if response.status_code != 200:
+            return None
+        return response.content
+
+    # Keep the newest files in the cache directory
+    def prune(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+        if len(files) <= self.entries:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
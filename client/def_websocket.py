@@ -1,40 +1,95 @@
+import json
+import time
+import random
+import threading
 import socketio
 
 from PyQt5.QtCore import QObject, pyqtSignal
 
+from def_wire import offered_encodings, decode
+from def_alerts import priority
+
 class WebSocket(QObject):
     password_changed = pyqtSignal(bool, str, str, str)
-    load_users = pyqtSignal(list)
-    load_alerts = pyqtSignal(list)
-    audio_alert = pyqtSignal(str, str)
+    load_users = pyqtSignal(dict)
+    user_joined = pyqtSignal(str, dict)
+    user_left = pyqtSignal(str)
+    load_alerts = pyqtSignal(list, str)
     display_alert = pyqtSignal(str, str)
+    show_alert = pyqtSignal(dict)
+    alert_seen = pyqtSignal(int, bool)
     logout = pyqtSignal()
+    login_result = pyqtSignal(int, dict)
     connected = pyqtSignal()
     disconnected = pyqtSignal()
-    def __init__(self, parent):
+    def __init__(self, parent, options):
         super().__init__()
         self.parent = parent
-        self.sio = socketio.Client()
+        # Reconnects are ours (see reconnect), not the Socket.IO client's
+        self.sio = socketio.Client(reconnection=False)
+        # Wire encodings offered in validate
+        self.encodings = offered_encodings(self.parent.config.get("WIRE", {}))
+        self.base_delay = options.get("base_delay", 1)
+        # Longest a connect attempt may take
+        self.connect_timeout = options.get("connect_timeout", 5)
+        self.max_delay = options.get("max_delay", 60)
+        # Whether we want to be connected, a drop while we do starts a reconnect loop
+        self.wanted = False
+        # Set to stop a reconnect loop, unset while one is running
+        self.stop_reconnect = threading.Event()
+        self.stop_reconnect.set()
+        # Version of the online users roster we last applied, and the epoch it belongs to
+        self.presence_version = None
+        self.presence_epoch = None
+        self.presence_resync = False
+        # Newest alert received live on this connection
+        self.live_seq = None
+        # Credentials waiting for the connection to come up
+        self.pending_login = None
+        # Thread running a connect for the GUI, one at a time
+        self.connect_thread = None
 
         @self.sio.event
         def connect():
+            self.live_seq = None
             self.connected.emit()
-            self.sio.emit("validate", { "token":self.parent.user.get("token") })
-            if self.parent.user.get("role") <= 3 and self.parent.alerts is None:
-                self.sio.emit("get_alerts", { "token":self.parent.user.get("token") })
+            if self.pending_login is not None:
+                # Connected to log in, the session starts once the login succeeds
+                self.sio.emit("login", self.pending_login)
+                self.pending_login = None
+                return
+            self.start_session()
 
         @self.sio.event
         def disconnect():
             self.disconnected.emit()
+            if self.wanted:
+                # Dropped, not asked to disconnect - come back, keeping what we know
+                self.start_reconnect()
 
         @self.sio.event
         def receive_alert(data):
+            data = decode(data)
             text = data.get("text")
             color = data.get("color")
             username = data.get("username")
             message = str(username) + ": " + str(text)
-            self.display_alert.emit(message, color)
-            self.audio_alert.emit(username, text)
+            alert = { "text":message, "color":color, "seq":data.get("seq"), "received":time.monotonic() }
+            repeat = data.get("repeat")
+            if repeat:
+                # Server folded repeats of an alert already shown, update it without speaking again
+                alert["text"] += " (x" + str(repeat) + ")"
+                alert["quiet"] = True
+            else:
+                # "audio" is the key of the server rendered speech, missing when the server doesn't render it
+                alert["speech"] = "From " + str(username) + ". " + str(text)
+                alert["audio"] = data.get("audio")
+            # Sequenced alerts are acknowledged once shown, see ack_alert
+            self.show_alert.emit(alert)
+            seq = data.get("seq")
+            if seq is not None:
+                self.live_seq = max(seq, self.live_seq or 0)
+                self.alert_seen.emit(seq, False)
                         
         @self.sio.event
         def reauthenticate(data):
@@ -43,17 +98,84 @@ class WebSocket(QObject):
 
         @self.sio.event
         def validate(data):
-            self.sio.emit("validate", { "token":self.parent.user.get("token") })
+            self.validate()
+
+        # Alerts broadcast while we were disconnected, oldest first
+        @self.sio.event
+        def missed_alerts(data):
+            data = decode(data)
+            alerts = data.get("alerts") or []
+            # Only those newer than any alert that already arrived live
+            unseen = [alert for alert in alerts if self.live_seq is None or alert.get("seq") > self.live_seq]
+            if unseen:
+                # Show one rather than replaying every alarm - the most urgent,
+                # newest first among equals, so a missed red isn't hidden by a later green
+                alert = min(reversed(unseen), key=lambda alert: priority(alert.get("color")))
+                message = str(alert.get("username")) + ": " + str(alert.get("text"))
+                message += " (" + str(len(unseen)) + ("+" if data.get("truncated") else "") + " missed)"
+                self.display_alert.emit(message, alert.get("color"))
+            # The server's count is authoritative (its log may have been reset),
+            # unless a newer alert already arrived live
+            self.alert_seen.emit(max(data.get("last_seq") or 0, self.live_seq or 0), True)
 
         @self.sio.event
         def alert_list(data):
             if self.parent.user.get("role") is None or self.parent.user.get("role") > 3:
                 return
-            self.load_alerts.emit(data)
+            self.load_alerts.emit(data, "")
+
+        @self.sio.event
+        def alert_catalog(data):
+            if self.parent.user.get("role") is None or self.parent.user.get("role") > 3:
+                return
+            catalog = json.loads(data)
+            self.load_alerts.emit(catalog.get("alerts"), catalog.get("version"))
 
         @self.sio.event
-        def online_users_list(data):
-            self.load_users.emit(data)
+        def alert_list_unchanged(data):
+            if self.parent.user.get("role") is None or self.parent.user.get("role") > 3:
+                return
+            self.load_alerts.emit(self.parent.user.get("alerts") or [], data.get("version"))
+
+        @self.sio.event
+        def online_users_snapshot(data):
+            data = decode(data)
+            self.presence_version = data.get("version")
+            self.presence_epoch = data.get("epoch")
+            self.presence_resync = False
+            self.load_users.emit(data.get("users"))
+
+        # What changed since the roster version we sent, instead of a snapshot
+        @self.sio.event
+        def online_users_changes(data):
+            data = decode(data)
+            if data.get("since") != self.presence_version:
+                self.presence_resync = False
+                self.apply_presence(data.get("version"))
+                return
+            for id in data.get("left") or []:
+                self.user_left.emit(id)
+            for id, user in (data.get("joined") or {}).items():
+                self.user_joined.emit(id, user)
+            self.presence_version = data.get("version")
+            self.presence_resync = False
+
+        @self.sio.event
+        def user_joined(data):
+            data = decode(data)
+            if self.apply_presence(data.get("version")):
+                self.user_joined.emit(data.get("id"), data.get("user"))
+
+        @self.sio.event
+        def user_left(data):
+            data = decode(data)
+            if self.apply_presence(data.get("version")):
+                self.user_left.emit(data.get("id"))
+
+        # Same answers as POST /login, "code" is the HTTP status it would have had
+        @self.sio.event
+        def login_result(data):
+            self.login_result.emit(data.get("code", 401), data)
 
         @self.sio.event
         def password_changed(data):
@@ -64,6 +186,58 @@ class WebSocket(QObject):
             self.password_changed.emit(success, error, color, username)
 
 
+    # Validate and fetch what the session needs, on connect or right after logging in
+    def start_session(self):
+        self.validate()
+        if self.parent.user.get("role") is not None and self.parent.user.get("role") <= 3 and self.parent.alerts is None:
+            # Send the version of the cached catalog, server only answers with changes
+            self.sio.emit("get_alerts", { "token":self.parent.user.get("token"), "version":self.parent.user.get("alerts_version") })
+
+    # Log in over the socket, connecting first if needed - answered with login_result
+    # The connect runs on its own thread so the window never waits for the server
+    def login(self, user_id, password):
+        credentials = { "user_id":user_id, "password":password }
+        if self.isConnected():
+            self.sio.emit("login", credentials)
+            return
+        threading.Thread(target=self.connect_to_login, args=(credentials,), name="websocket-login", daemon=True).start()
+
+    def connect_to_login(self, credentials):
+        self.pending_login = credentials
+        if not self.connect():
+            self.pending_login = None
+            self.login_result.emit(0, {})
+
+    # Send the session token, the roster version we hold and the last alert we saw
+    # Together they let the server resume the session, sending only what changed
+    def validate(self):
+        # Deltas arriving before the server's answer can't be placed yet, don't resync over them
+        self.presence_resync = self.presence_version is not None
+        self.sio.emit("validate", {
+            "token":self.parent.user.get("token"),
+            "presence":self.presence_version,
+            "presence_epoch":self.presence_epoch,
+            "last_seq":self.parent.user.get("last_seq"),
+            "encodings":self.encodings,
+        })
+
+    # Deltas must arrive in version order, otherwise ask for a fresh snapshot
+    def apply_presence(self, version):
+        if self.presence_version is None:
+            return False
+        if version == self.presence_version + 1:
+            self.presence_version = version
+            return True
+        if version > self.presence_version and not self.presence_resync:
+            self.presence_resync = True
+            self.sio.emit("get_online_users", { "token":self.parent.user.get("token"), "version":self.presence_version, "epoch":self.presence_epoch })
+        return False
+
+    # Report how long an alert took from arriving to being on screen, and to its klaxon starting
+    def ack_alert(self, seq, received, audio_delay=None):
+        if self.isConnected():
+            self.sio.emit("alert_ack", { "seq":seq, "display_delay":time.monotonic() - received, "audio_delay":audio_delay })
+
     def change_password(self, data):
         self.sio.emit("change_password", data)
 
@@ -73,10 +247,68 @@ class WebSocket(QObject):
     def isConnected(self):
         return self.sio.connected
 
+    # Connect to server when AlertDisplay initialized
+    # Returns False when the server can't be reached, a logged in client keeps retrying in the background
     def connect(self):
-        # Connect to server when AlertDisplay initialized
-        self.sio.connect(self.parent.SERVER_URL)
+        if not self.stop_reconnect.is_set():
+            # Reconnect loop is already on it
+            return False
+        self.wanted = True
+        try:
+            self.sio.connect(self.parent.SERVER_URL, wait_timeout=self.connect_timeout)
+        except socketio.exceptions.ConnectionError:
+            if self.parent.user.get("token") is not None:
+                self.start_reconnect()
+            else:
+                self.wanted = False
+            return False
+        if not self.wanted:
+            # disconnect() ran while this connect was in flight
+            self.sio.disconnect()
+            return False
+        return True
+
+    # connect() on its own thread so the window never waits for the server,
+    # the connected signal reports when it is up
+    def connect_async(self):
+        if self.connect_thread is not None and self.connect_thread.is_alive():
+            return
+        self.connect_thread = threading.Thread(target=self.connect, name="websocket-connect", daemon=True)
+        self.connect_thread.start()
+
+    # Full jitter - a random wait up to a doubling cap, so clients dropped
+    # together (a server restart) come back spread out instead of in lockstep
+    # The exponent stops growing long after max_delay is reached, so a long outage can't overflow the float
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** min(attempt, 32)))
+
+    def start_reconnect(self):
+        if not self.stop_reconnect.is_set() or self.parent.user.get("token") is None:
+            # Already reconnecting, or nothing to come back to
+            return
+        self.stop_reconnect.clear()
+        threading.Thread(target=self.reconnect, name="websocket-reconnect", daemon=True).start()
+
+    def reconnect(self):
+        attempt = 0
+        while not self.stop_reconnect.wait(self.backoff(attempt)):
+            try:
+                self.sio.connect(self.parent.SERVER_URL, wait_timeout=self.connect_timeout)
+            except socketio.exceptions.ConnectionError:
+                attempt += 1
+                continue
+            if not self.wanted:
+                # disconnect() or a logout ran while this connect was in flight
+                self.sio.disconnect()
+            break
+        self.stop_reconnect.set()
 
     def disconnect(self):
-        self.sio.disconnect()
+        self.wanted = False
+        self.stop_reconnect.set()
+        self.presence_version = None
+        self.presence_epoch = None
+        self.presence_resync = False
+        if self.sio.connected:
+            self.sio.disconnect()
 
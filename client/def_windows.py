@@ -1,7 +1,5 @@
-import requests
-
 from PyQt5.QtWidgets import QDialog, QFrame, QRadioButton, QHBoxLayout, QTextEdit, QFormLayout, QLineEdit, QPushButton, QSlider, QLabel
-from PyQt5.QtCore import Qt, QCoreApplication, QEvent
+from PyQt5.QtCore import Qt, QEvent
 
 # Define the login window
 class LoginWindow(QDialog):
@@ -44,16 +42,24 @@ class LoginWindow(QDialog):
         if user_id and password:
             self.parent.display_alert("Logging in ...","lightgrey")
             self.hide()
-            QCoreApplication.processEvents()
+            # Log in on the socket the session will use, answered through login_done
+            self.parent.ws.login(user_id, password)
 
-            response = requests.post(f"{self.parent.SERVER_URL}/login", data={"user_id": user_id, "password": password})
-            if response.status_code == 200:
-                data = response.json()
-                newuser = { "token":data["token"], "role":data["role"], "username":data["username"] }
-                self.parent.user.update_preferences(newuser)
-                self.parent.update_ui()
-            else:
-                self.parent.display_alert("Invalid credentials","orange")
+    # Answer to a login - status 0 means the server couldn't be reached
+    def login_done(self, status, data):
+        if status == 200:
+            newuser = { "token":data["token"], "role":data["role"], "username":data["username"] }
+            self.parent.user.update_preferences(newuser)
+            self.parent.update_ui()
+            if self.parent.ws.isConnected():
+                # Logged in over the socket, carry on with the same connection
+                self.parent.ws.start_session()
+        elif status == 503:
+            self.parent.display_alert("Server is busy, please try again","orange")
+        elif status == 0:
+            self.parent.display_alert("Server unreachable, please try again","orange")
+        else:
+            self.parent.display_alert("Invalid credentials","orange")
 
 # Define the login window
 class PasswordWindow(QDialog):
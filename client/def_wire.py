@@ -0,0 +1,60 @@
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Wire encodings offered to the server in validate
+# The server answers busy events (alerts, roster, presence) in the first
+# encoding it also speaks, MessagePack arrives as bytes with short field
+# tags, anything else is JSON and arrives already decoded.
+
+# Field name -> tag, keep in step with the server's copy
+FIELD_TAGS = {
+    "username":"u",
+    "text":"t",
+    "color":"c",
+    "seq":"s",
+    "sent_at":"at",
+    "audio":"a",
+    "repeat":"r",
+    "version":"v",
+    "id":"i",
+    "user":"U",
+    "users":"us",
+    "name":"n",
+    "icon":"ic",
+    "role":"ro",
+    "group":"g",
+    "since":"si",
+    "joined":"j",
+    "left":"l",
+    "epoch":"e",
+    "alerts":"al",
+    "last_seq":"ls",
+    "truncated":"tr",
+}
+TAG_FIELDS = { tag:field for field, tag in FIELD_TAGS.items() }
+
+CONTAINERS = (dict, list)
+
+# Only containers are recursed into, a call per scalar would double the roster's decode time
+def untag_fields(data):
+    if isinstance(data, dict):
+        return { TAG_FIELDS.get(key, key):untag_fields(value) if isinstance(value, CONTAINERS) else value for key, value in data.items() }
+    return [untag_fields(value) if isinstance(value, CONTAINERS) else value for value in data]
+
+# Encodings to offer, most preferred first, skipping ones not installed
+def offered_encodings(options):
+    offered = []
+    for name in options.get("encodings", ["json"]):
+        if name == "msgpack" and msgpack is None:
+            continue
+        offered.append(name)
+    return offered
+
+# Event payload as sent by the server, whatever the encoding
+def decode(data):
+    if isinstance(data, (bytes, bytearray)) and msgpack is not None:
+        data = msgpack.unpackb(data, raw=False)
+        return untag_fields(data) if isinstance(data, CONTAINERS) else data
+    return data
@@ -1,131 +1,431 @@
 import sys
 import os
+
+from def_utilities import local_file, read_json, timestamp, set_async_mode
+
+# Map config stuff into constants for clarity
+config = read_json(local_file("config.json"))
+ASYNC_MODE = config.get("ASYNC_MODE", "threading")
+
+# Green thread servers must patch the standard library before anything else imports it
+if ASYNC_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+set_async_mode(ASYNC_MODE)
+
 from flask import Flask, request, jsonify
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms as joined_rooms
 import random
 import json
+import time
 import atexit
-import bcrypt
 
-from def_utilities import local_file, read_json
-from def_stores import SimpleStore, UserStore
+# Structured logs are written from a background thread, set up before the stores log anything
+from def_logging import setup_logging, stop_logging, get_logger, dropped
+setup_logging(config.get("LOGGING", {}))
+atexit.register(stop_logging)
+log = get_logger("app")
+
+from def_stores import SimpleStore, UserStore, TokenStore, SessionCache, PresenceStore, SharedPresenceStore, AlertCatalog, AlertLog
+from def_workers import HashPool, PoolBusy
+from def_metrics import DeliveryTracker, REGISTRY, instrument_event, instrument_route
+from def_limits import RateLimiter, AlertCoalescer
+from def_rooms import user_rooms, audience_rooms
+from def_tts import TtsCache
+from def_wire import Wire, EVERYONE_ROOM
 
-# Map config stuff into constants for clarity
-config = read_json(local_file("config.json"))
 PORT = config["PORT"]
 USER_STORE = config["USER_STORE"]
 DATA_STORE = config["DATA_STORE"]
 TOKEN_STORE = config["TOKEN_STORE"]
 ONLINE_USER_STORE = config["ONLINE_USER_STORE"]
+SESSION_CACHE = config["SESSION_CACHE"]
+HASH_POOL = config["HASH_POOL"]
+MESSAGE_QUEUE = config.get("MESSAGE_QUEUE", { "type":"none" })
+ALERT_LIMITS = config.get("ALERT_LIMITS", {})
+ALERT_LOG = config["ALERT_LOG"]
+TTS = config.get("TTS", { "backend":"none" })
+WIRE = config.get("WIRE", { "encodings":["json"] })
 
 # Initialize the flask webserver
 app = Flask(__name__)
 # Initialize the websocket server
-socketio = SocketIO(app, cors_allowed_origins="*") 
+# NOTE: With a message queue, broadcasts reach the clients of every server process
+socketio_options = {}
+if MESSAGE_QUEUE.get("type") == "unix":
+    from def_broker import UnixSocketManager
+    socketio_options["client_manager"] = UnixSocketManager(MESSAGE_QUEUE.get("path"))
+elif MESSAGE_QUEUE.get("type") != "none":
+    # redis://, kafka://, amqp:// ... handled by Flask-SocketIO
+    socketio_options["message_queue"] = MESSAGE_QUEUE.get("url")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, **socketio_options) 
 # Initialize the user store - user details, password, role etc
 users = UserStore(USER_STORE) 
 # Initialize the token store - used for maintaining and authenticating sessions
-tokens = SimpleStore(TOKEN_STORE)
+if TOKEN_STORE.get("type") == "sqlite":
+    tokens = TokenStore(TOKEN_STORE)
+else:
+    tokens = SimpleStore(TOKEN_STORE)
 # Initialize the data store - alerts
 support_data = SimpleStore(DATA_STORE)
+# Initialize the alert catalog - alerts from the data store, pre-sorted and pre-encoded
+alert_catalog = AlertCatalog(support_data)
+# Initialize the alert log - every broadcast alert, replayed to clients that missed them
+alert_log = AlertLog(ALERT_LOG)
 # Initialize the online-users store - nonpersistent store of users
-online_users = {}
-
-print("Datastores have been connected")
+if ONLINE_USER_STORE.get("type") == "sqlite":
+    # Shared by every server process using the same file
+    online_users = SharedPresenceStore(ONLINE_USER_STORE)
+else:
+    online_users = PresenceStore(ONLINE_USER_STORE)
+# Initialize the session cache - authenticated users by token, saves a store lookup per event
+# NOTE: Logouts and user edits only invalidate the cache of the process handling them, so
+# with a message queue (several processes) it is off - other processes would keep
+# serving a logged out or demoted session until the entry expires
+if MESSAGE_QUEUE.get("type") != "none" and SESSION_CACHE.get("enabled", True):
+    log.warning("session_cache_disabled", reason="message_queue")
+    SESSION_CACHE = dict(SESSION_CACHE, enabled=False)
+sessions = SessionCache(SESSION_CACHE)
+# Initialize the hash pool - bcrypt hashing and checks run here, off the socket threads
+hasher = HashPool(HASH_POOL, ASYNC_MODE)
+# Initialize the delivery tracker - alert sequence numbers and latency histograms
+deliveries = DeliveryTracker()
+# Initialize the alert limits - token buckets per user and overall, and folding of repeated alerts
+alert_limiter = RateLimiter(ALERT_LIMITS)
+alert_coalescer = AlertCoalescer(ALERT_LIMITS.get("coalesce_window", 2))
+# Initialize the TTS cache - spoken alerts rendered once and served to every client by hash
+# NOTE: With "backend":"none" clients synthesize the speech themselves
+# NOTE: Only texts of alerts that were sent are rendered, keys from other processes are found in the alert log
+tts = TtsCache(TTS, lambda key: spoken_alert_text(key)) if TTS.get("backend") != "none" else None
+# Wire encodings clients may pick in validate, JSON is always one of them
+# NOTE: With a message queue every node needs the same WIRE encodings, and fails to start if one is unavailable
+wire = Wire(WIRE, MESSAGE_QUEUE.get("type") != "none")
+
+# Register the metrics read at scrape time
+deliveries.register(REGISTRY)
+REGISTRY.callback("gauge", "manifest_online_users", "Validated socket connections", lambda: online_users.size())
+REGISTRY.callback("gauge", "manifest_tokens", "Sessions in the token store", lambda: tokens.size())
+REGISTRY.callback("counter", "manifest_session_cache_hits_total", "Session cache hits", lambda: sessions.hits)
+REGISTRY.callback("counter", "manifest_session_cache_misses_total", "Session cache misses", lambda: sessions.misses)
+REGISTRY.callback("counter", "manifest_hash_pool_rejected_total", "bcrypt jobs refused because the pool was full", lambda: hasher.rejected)
+REGISTRY.callback("counter", "manifest_alerts_coalesced_total", "Repeated alerts folded into an earlier broadcast", lambda: alert_coalescer.folded)
+if tts is not None:
+    REGISTRY.callback("counter", "manifest_tts_renders_total", "Alert texts synthesized", lambda: tts.renders)
+    REGISTRY.callback("counter", "manifest_tts_cache_hits_total", "Spoken alerts served from the cache", lambda: tts.hits)
+REGISTRY.callback("counter", "manifest_log_dropped_total", "Log records dropped because the log queue was full", dropped)
+
+log.info("datastores_connected")
 
 def close():
     # Disconnect from datastores when server disconnects
+    log.info("datastores_closing", user_store=users.stats(), session_cache=sessions.stats(), hash_pool=hasher.stats())
     users.close()
     tokens.close()
     support_data.close()
-    # online_users.close()
-    print("Datastores have been closed")
+    alert_log.close()
+    online_users.close()
+    if tts is not None:
+        log.info("tts_stats", tts=tts.stats())
+    sessions.close()
+    hasher.close()
+    log.info("datastores_closed")
+
+# Columns each caller needs, so lookups skip the rest (password hash included)
+SESSION_FIELDS = ("id", "token", "role", "username", "icon", "color", "group")
+LOGIN_FIELDS = ("id", "password", "role", "username", "token")
 
 def get_user(token):
-    user_id = tokens.get(str(token))
+    if token is None:
+        return None
+    token = str(token)
+
+    # Serve authenticated events from the session cache when possible
+    user = sessions.get(token)
+    if user is not None:
+        return user
+
+    user_id = tokens.get(token)
     if user_id is None:
         return None
     
-    user = users.get(user_id)
+    # Taken before the read, an invalidation in between stops a stale row being cached
+    generation = sessions.generation(user_id)
+    user = users.get(user_id, fields=SESSION_FIELDS)
     if user is None or user.get("token") != token:
         return None
     
+    sessions.set(token, user, generation)
     return user
 
-def hash_password(password):
-    password = password.encode('utf-8')  # Passwords should be bytes
-    salt = bcrypt.gensalt()  # Generate a random salt
-    return bcrypt.hashpw(password, salt)  # Hash the password
+# Clients that don't understand presence deltas still get the full list on every change
+LEGACY_PRESENCE_ROOM = "presence:legacy"
+def emit_legacy_users():
+    emit("online_users_list", [public_info(info) for info in online_users.users()], to=LEGACY_PRESENCE_ROOM)
+
+# Roster fields only admins get - every user's privilege level and group
+ADMIN_PRESENCE_FIELDS = ("role", "group")
+# Every validated connection joins one of these, joins reach the admin room with the admin fields
+ADMIN_PRESENCE_ROOM = "presence:admin"
+PUBLIC_PRESENCE_ROOM = "presence:public"
+
+def presence_room(user):
+    if user.get("role") is not None and user.get("role") <= 3:
+        return ADMIN_PRESENCE_ROOM
+    return PUBLIC_PRESENCE_ROOM
+
+# Roster entry without the admin-only fields
+def public_info(info):
+    return { key:value for key, value in info.items() if key not in ADMIN_PRESENCE_FIELDS }
+
+# Roster snapshot ("users") or changes ("joined") as a user may see them
+def presence_for(user, roster):
+    if presence_room(user) == ADMIN_PRESENCE_ROOM:
+        return roster
+    field = "users" if "users" in roster else "joined"
+    return dict(roster, **{ field:{ sid:public_info(info) for sid, info in roster[field].items() } })
+
+# Send to the requesting connection in its wire encoding
+def emit_encoded(event, data):
+    emit(event, wire.encode(wire.encoding(request.sid), data), broadcast=False)
+
+# Send to rooms (None for every validated connection) plus optionally one
+# connection, encoded once per wire encoding instead of once per client
+def broadcast_encoded(event, data, rooms=None, sid=None, skip_sid=None):
+    if rooms is None:
+        rooms = (EVERYONE_ROOM,)
+    sid_encoding = wire.encoding(sid) if sid is not None else None
+    for name in wire.names():
+        to = [wire.room(room, name) for room in rooms]
+        if name == sid_encoding:
+            to.append(sid)
+        socketio.emit(event, wire.encode(name, data), to=to, skip_sid=skip_sid)
+
+# Log an alert and send it to the audience's rooms (None for every client)
+# plus the sender's connection, the log assigns the sequence number
+def broadcast_alert(message, rooms, sender):
+    sent_at = time.time()
+    seq = alert_log.append(message, sent_at, rooms)
+    message = dict(message, seq=seq, sent_at=sent_at)
+    started = time.perf_counter()
+    broadcast_encoded("receive_alert", message, rooms, None if rooms is None else sender)
+    deliveries.sent_alert(seq, started)
+    return seq
+
+# What clients say when an alert arrives, must match the client's wording
+def spoken_text(username, text):
+    return "From "+str(username)+". "+str(text)
+
+# Spoken text of the alert sent with an audio key, None if no alert was
+def spoken_alert_text(audio):
+    message = alert_log.spoken(audio)
+    if message is None:
+        return None
+    return spoken_text(message.get("username"), message.get("text"))
 
-# Define the logout route for the webserver 
-@app.route("/logout", methods=["POST"])
-def logout():
-    token = str(request.form["token"])
+# Token sent as "Authorization: Bearer <token>", kept out of URLs (and access logs)
+def header_token():
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return None
+    return header[len("Bearer "):]
+
+# Runs when a coalescing window closes, sends the repeat count if the alert was repeated
+def broadcast_repeats(key, message, rooms, sender):
+    socketio.sleep(alert_coalescer.window)
+    repeats = alert_coalescer.close(key)
+    if repeats:
+        seq = broadcast_alert(dict(message, repeat=repeats + 1), rooms, sender)
+        log.info("alert_repeated", seq=seq, repeat=repeats + 1, color=message["color"])
+
+# Roster for a presence-aware client - the changes since the version it holds
+# when they are still known ("online_users_changes"), the full roster otherwise
+def send_presence(user, data):
+    since = data.get("presence")
+    if data.get("presence_epoch") == online_users.epoch and isinstance(since, int) and not isinstance(since, bool):
+        changes = online_users.changes_since(since)
+        if changes is not None:
+            return emit_encoded("online_users_changes", presence_for(user, changes))
+    emit_encoded("online_users_snapshot", presence_for(user, online_users.snapshot()))
+
+# Reply sent when the hash pool is saturated
+def busy_message():
+    return {
+        "success":False,
+        "error":"The server is busy, please try again",
+        "color":"orange",
+        "username":"System"
+    }
+
+# End a session, returns (reply, http status)
+def end_session(token):
+    token = str(token)
     user_id = tokens.get(token)
     if user_id:
         tokens.rem(token)
-        users.edit(user_id, {"token":None})
-        return jsonify({"status": "success"})
+        users.edit(user_id, {"token":None}, defer=True)
+        # After the writes, so a lookup racing them can't cache the session again
+        sessions.rem(token, user_id)
+        return {"status": "success"}, 200
     # Otherwise fail
-    return jsonify({"status": "failed"}), 401
-        
-# Define the login route for the webserver 
-@app.route("/login", methods=["POST"])
-def login():
-    # Parse the user ID and password from the login data 
-    user_id = request.form.get("user_id")
-    password = request.form.get("password") 
+    return {"status": "failed"}, 401
 
+# Check credentials and start a session, returns (reply, http status)
+# Shared by the login route and the login socket event
+def authenticate(user_id, password):
     # Lookup the user ID requested
-    user = users.get(user_id)
-    print(user)
+    user = users.get(user_id, fields=LOGIN_FIELDS)
     if user is None:
-        return jsonify({"status": "failed"}), 401
-
-    if not bcrypt.checkpw(password.encode('utf-8'), user.get("password")):
-        return jsonify({"status": "failed"}), 401
+        log.info("login", user_id=user_id, result="unknown_user")
+        return {"status": "failed"}, 401
+
+    try:
+        if not hasher.check(password, user.get("password")):
+            log.info("login", user_id=user_id, result="failed")
+            return {"status": "failed"}, 401
+    except PoolBusy:
+        # Back-pressure: too many logins in flight, client should retry
+        log.warning("login", user_id=user_id, result="busy")
+        return {"status": "busy"}, 503
 
     #if user and password == user.get("password"):
     tokens.rem(user.get("token"))
     token = str(random.getrandbits(128))
-    users.edit(user_id, {"token":token})
+    # Token and timestamp can ride the next batched commit
+    users.edit(user_id, {"token":token, "last_login":timestamp()}, defer=True)
     tokens.set(token, user_id)
-    return jsonify({"status": "success", "role": user.get("role"), "token":token, "username":user.get("username") })
+    # After the writes, so a lookup racing them can't cache the old session again
+    sessions.rem_user(user_id)
+    log.info("login", user_id=user_id, result="success")
+    return {"status": "success", "role": user.get("role"), "token":token, "username":user.get("username") }, 200
+
+# Define the logout route for the webserver 
+@app.route("/logout", methods=["POST"])
+@instrument_route("logout")
+def logout():
+    reply, status = end_session(request.form["token"])
+    return jsonify(reply), status
+        
+# Define the login route for the webserver 
+@app.route("/login", methods=["POST"])
+@instrument_route("login")
+def login():
+    # Parse the user ID and password from the login data 
+    reply, status = authenticate(request.form.get("user_id"), request.form.get("password"))
+    return jsonify(reply), status
+
+
+# Prometheus scrape endpoint
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return REGISTRY.render(), 200, { "Content-Type":"text/plain; version=0.0.4" }
+
+# Spoken audio of an alert, by the key sent in the alert's "audio" field
+@app.route("/tts/<key>", methods=["GET"])
+@instrument_route("tts")
+def tts_audio(key):
+    if tts is None:
+        return jsonify({"status": "failed"}), 404
+    if get_user(header_token()) is None:
+        return jsonify({"status": "failed"}), 401
+    audio = tts.get(key)
+    if audio is None:
+        return jsonify({"status": "failed"}), 404
+    # Same key, same audio - clients and proxies may keep it
+    return audio, 200, { "Content-Type":tts.backend.mimetype, "Cache-Control":"private, max-age=31536000, immutable" }
+
+# Alert fan-out and delivery latency percentiles
+@app.route("/metrics/latency", methods=["GET"])
+def latency_metrics():
+    return jsonify(deliveries.summary())
 
 
 # Define the routine to run when a user connects to the server
 @socketio.on("connect")
-def handle_connect():
+@instrument_event("connect")
+def handle_connect(auth=None):
     # Note: Client will validate when connected - event will add or update the online user information there
-    print("Client connected")
+    log.info("connect", sid=request.sid)
 
 # Define the routine to run when a user disconnects from the server
 @socketio.on("disconnect")
-def handle_disconnect():
-    print("Client disconnected")
+@instrument_event("disconnect")
+def handle_disconnect(reason=None):
+    log.info("disconnect", sid=request.sid, reason=reason)
     # User has disconnected, delete online user info
-    user = online_users.pop(request.sid)
-    emit("online_users_list", list(online_users.values()), broadcast=True)
+    left = online_users.leave(request.sid)
+    if left is None:
+        return
+    version, entry = left
+    users.edit(entry["id"], {"last_disconnect":timestamp()}, defer=True)
+    broadcast_encoded("user_left", { "version":version, "id":request.sid })
+    wire.forget(request.sid)
+    emit_legacy_users()
+
+# Login over the socket, so a client needs one connection instead of an HTTP
+# request and then a socket. Replies with "login_result", the client then validates
+@socketio.on("login")
+@instrument_event("login")
+def handle_login(data):
+    reply, status = authenticate(data.get("user_id"), data.get("password"))
+    emit("login_result", dict(reply, code=status), broadcast=False)
 
 # Define the routine to validate the user session
 @socketio.on("validate")
+@instrument_event("validate")
 def handle_validate(data):
     user = get_user(data.get("token"))
     if user is None:
         return emit("reauthenticate", {}, broadcast=False)
 
     # User has connected and validated, set online user info
-    online_users[request.sid] = { 
+    info = { 
         "name":user.get('username'), 
         "icon":user.get('icon'),
         "color":user.get('color'),
+        "role":user.get('role'),
+        "group":user.get('group'),
     }
-    emit("online_users_list", list(online_users.values()), broadcast=True)
+    version = online_users.join(request.sid, user.get("id"), info)
+    # Wire encoding for this connection, JSON unless the client offers one we speak
+    encoding = wire.negotiate(request.sid, data.get("encodings"))
+    # Rooms targeted alerts are sent to, in this connection's encoding
+    # NOTE: Role or group changes take effect on the user's next validate, which leaves the old rooms
+    rooms = user_rooms(user)
+    wanted = set(wire.room(room, encoding) for room in rooms + [EVERYONE_ROOM, presence_room(user)])
+    for room in joined_rooms():
+        if room not in wanted and room not in (request.sid, LEGACY_PRESENCE_ROOM):
+            leave_room(room)
+    for room in wanted:
+        join_room(room)
+    users.edit(user.get("id"), {"last_connect":timestamp()}, defer=True)
+    broadcast_encoded("user_joined", { "version":version, "id":request.sid, "user":info }, (ADMIN_PRESENCE_ROOM,), skip_sid=request.sid)
+    broadcast_encoded("user_joined", { "version":version, "id":request.sid, "user":public_info(info) }, (PUBLIC_PRESENCE_ROOM,), skip_sid=request.sid)
+
+    if "presence" in data:
+        # Presence-aware client, send it the roster once and deltas from then on
+        # A reconnecting client only gets what changed while it was away
+        send_presence(user, data)
+    else:
+        # Older client, keep sending it the full list on every change
+        join_room(LEGACY_PRESENCE_ROOM)
+    emit_legacy_users()
+
+    if "last_seq" in data:
+        # Alerts broadcast while this client was away (none for a client that hasn't seen one yet)
+        last_seq = data.get("last_seq")
+        if isinstance(last_seq, int):
+            emit_encoded("missed_alerts", alert_log.replay(last_seq, rooms))
+        else:
+            emit_encoded("missed_alerts", { "alerts":[], "last_seq":alert_log.head(), "truncated":False })
 
 
 # Define the routine to run when a "send_alert" request is sent by user
 # NOTE: This is where the data sent by admin gets re-broadcast out to all the connected users
 @socketio.on("send_alert")
+@instrument_event("send_alert")
 def handle_send_alert(data):
     user = get_user(data.get("token"))
     if user is None:
@@ -133,13 +433,46 @@ def handle_send_alert(data):
 
     if user.get("role") <= 3:
         # User was found and has permission to broadcast
+        try:
+            rooms = audience_rooms(data.get("audience"))
+        except ValueError as e:
+            message = {
+                "text":str(e),
+                "color":"orange",
+                "username":"System"
+            }
+            return emit("receive_alert", message, broadcast=False)
+
         message = {
             "text":data["text"],
             "color":data["color"],
             "username":user.get("username")
         }
-        emit("receive_alert", message, broadcast=True)
-        print("Broadcasting alert from "+user.get("username"))
+        # Repeats of an alert that just went out are only counted
+        key = (message["text"], message["color"], message["username"], rooms)
+        if alert_coalescer.fold(key):
+            return
+
+        scope = alert_limiter.allow(user.get("id"))
+        if scope is not None:
+            message = {
+                "text":"Too many alerts, please wait before sending another",
+                "color":"orange",
+                "username":"System"
+            }
+            log.warning("alert_rate_limited", user_id=user.get("id"), scope=scope)
+            return emit("receive_alert", message, broadcast=False)
+
+        if not alert_coalescer.open(key):
+            return
+        if tts is not None:
+            # Start rendering now, clients will ask for it as soon as the alert lands
+            message["audio"] = tts.remember(spoken_text(message["username"], message["text"]))
+            socketio.start_background_task(tts.prefetch, message["audio"])
+        seq = broadcast_alert(message, rooms, request.sid)
+        if alert_coalescer.window > 0:
+            socketio.start_background_task(broadcast_repeats, key, message, rooms, request.sid)
+        log.info("alert_broadcast", user_id=user.get("id"), seq=seq, color=data["color"], rooms=rooms)
     else:
         # User was found but does not have permission to broadcast
         message = {
@@ -148,36 +481,65 @@ def handle_send_alert(data):
             "username":"System"
         }
         emit("receive_alert", message, broadcast=False)
-        print("User does not have permission to send alerts")
+        log.warning("alert_denied", user_id=user.get("id"))
+
+# Clients acknowledge each alert once it is on screen
+@socketio.on("alert_ack")
+@instrument_event("alert_ack")
+def handle_alert_ack(data):
+    deliveries.acked(data.get("seq"), data.get("display_delay"), data.get("audio_delay"))
 
 @socketio.on("get_alerts")
+@instrument_event("get_alerts")
 def handle_get_alerts(data):
     user = get_user(data.get("token"))
     if user is None:
         return emit("reauthenticate", {}, broadcast=False)
 
-    emit("alert_list", support_data.get("alerts"), broadcast=False)
-    print("Sending alerts to "+user.get("username"))
+    if "version" not in data:
+        # Older client, send the plain list
+        emit("alert_list", alert_catalog.alerts, broadcast=False)
+    elif data.get("version") == alert_catalog.version:
+        # Client's cached catalog is current
+        return emit("alert_list_unchanged", { "version":alert_catalog.version }, broadcast=False)
+    else:
+        # Already json encoded, the client decodes it
+        emit("alert_catalog", alert_catalog.encoded, broadcast=False)
+    log.debug("alerts_sent", user_id=user.get("id"))
 
 @socketio.on("get_online_users")
+@instrument_event("get_online_users")
 def handle_get_online_users(data):
     user = get_user(data.get("token"))
     if user is None:
         return emit("reauthenticate", {}, broadcast=False)
 
-    emit("online_users_list", list(online_users.values()), broadcast=False)
-    print("Sending online users to " + user.get("username"))
+    if "version" in data:
+        # Resync for a presence-aware client that missed a delta
+        send_presence(user, { "presence":data.get("version"), "presence_epoch":data.get("epoch") })
+    elif presence_room(user) == ADMIN_PRESENCE_ROOM:
+        emit("online_users_list", online_users.users(), broadcast=False)
+    else:
+        emit("online_users_list", [public_info(info) for info in online_users.users()], broadcast=False)
+    log.debug("online_users_sent", user_id=user.get("id"))
 
 @socketio.on("change_password")
+@instrument_event("change_password")
 def handle_get_online_users(data):
     user = get_user(data.get("token"))
     if user is None:
         return emit("reauthenticate", {}, broadcast=False)
 
-    old_password = data.get("old_password").encode('utf-8')
+    old_password = data.get("old_password")
     
     # Old password must pass
-    if not bcrypt.checkpw(old_password, user.get("password")):
+    # NOTE: Sessions don't carry the password hash, fetch it just for this check
+    stored = users.get(user.get("id"), fields=("password",))
+    try:
+        password_ok = stored is not None and hasher.check(old_password, stored.get("password"))
+    except PoolBusy:
+        return emit("password_changed", busy_message(), broadcast=False)
+    if not password_ok:
         message = {
             "success":False,
             "error":"Your old password does not match the current password",
@@ -206,8 +568,12 @@ def handle_get_online_users(data):
         }
         return emit("password_changed", message, broadcast=False)
 
-    hashed_password = hash_password(new_password)
+    try:
+        hashed_password = hasher.hash(new_password)
+    except PoolBusy:
+        return emit("password_changed", busy_message(), broadcast=False)
     users.edit(user.get("id"), { "password":hashed_password })
+    sessions.rem_user(user.get("id"))
     message = {
         "success":True,
         "error":None,
@@ -219,6 +585,7 @@ def handle_get_online_users(data):
 
 # Admin controls
 @socketio.on("create_user")
+@instrument_event("create_user")
 def creat_new_user(data):
     user = get_user(data.get("token"))
     if user is None:
@@ -282,10 +649,15 @@ def creat_new_user(data):
         new_user["role"] = user.get("role") + 1
 
     # Hash the password
-    new_user["password"] = hash_password(new_user["password"])
+    try:
+        new_user["password"] = hasher.hash(new_user["password"])
+    except PoolBusy:
+        return emit("user_created", busy_message(), broadcast=False)
 
     # Set new user in database
-    users.set(data.get("user"))
+    # NOTE: An existing id is replaced, so any cached session of the old user is dropped after the write
+    users.set(new_user)
+    sessions.rem_user(new_user.get("id"))
 
     message = {
         "success":True,
@@ -296,6 +668,7 @@ def creat_new_user(data):
     return emit("user_created", message, broadcast=False)
 
 @socketio.on("edit_user")
+@instrument_event("edit_user")
 def creat_new_user(data):
     user = get_user(data.get("token"))
     if user is None:
@@ -339,10 +712,24 @@ def creat_new_user(data):
 
     # If has password, hash it first
     if edit_user.get("password") is not None:
-        edit_user["password"] = hash_password(edit_user["password"])
+        try:
+            edit_user["password"] = hasher.hash(edit_user["password"])
+        except PoolBusy:
+            return emit("user_edited", busy_message(), broadcast=False)
 
     # Edit user in database
-    users.edit(data.get("user"))
+    user_id = edit_user.pop("id")
+    try:
+        users.edit(user_id, edit_user)
+    except ValueError as e:
+        message = {
+            "success":False,
+            "error":str(e),
+            "color":"red",
+            "username":"System"
+        }
+        return emit("user_edited", message, broadcast=False)
+    sessions.rem_user(user_id)
 
     message = {
         "success":True,
@@ -353,8 +740,11 @@ def creat_new_user(data):
     return emit("user_edited", message, broadcast=False)
 
 
+# Registered after stop_logging so it runs first and its records get written
 atexit.register(close)
 
 # Start server on port 5000 
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=PORT, debug=False)
+    # Optional port argument, to run several server processes on one machine
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    socketio.run(app, host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,89 @@
+import sys
+import time
+import json
+import threading
+import statistics
+
+from def_workers import HashPool, PoolBusy, hash_password
+
+# Benchmark: alert fan-out responsiveness during a login storm
+#
+# A "fan-out" thread wakes every TICK seconds and encodes an alert for
+# CLIENTS connections, like handle_send_alert does. At the same time LOGINS
+# threads each verify a bcrypt password, either inline on their own thread
+# (the old behaviour) or through a HashPool. The lateness of each fan-out
+# tick shows how much the storm starves the broadcast path.
+#
+# Usage: python bench_hash_pool.py [logins] [workers] [queue]
+
+TICK = 0.01
+CLIENTS = 1000
+
+def fan_out(stop, lateness):
+    message = { "text":"Base is under attack", "color":"red", "username":"SUPER" }
+    outbox = []
+    next_tick = time.perf_counter()
+    while not stop.is_set():
+        next_tick += TICK
+        delay = next_tick - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        started = time.perf_counter()
+        lateness.append(started - next_tick)
+        # Don't let a late tick push every following tick late too
+        next_tick = max(next_tick, started)
+        outbox.clear()
+        for n in range(CLIENTS):
+            outbox.append(json.dumps(message))
+
+def storm(pool, logins, hashed):
+    results = {"ok":0, "busy":0}
+    lock = threading.Lock()
+
+    def login():
+        try:
+            pool.check("password1", hashed)
+            key = "ok"
+        except PoolBusy:
+            key = "busy"
+        with lock:
+            results[key] += 1
+
+    threads = [threading.Thread(target=login) for n in range(logins)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+def run(name, pool, logins, hashed):
+    stop = threading.Event()
+    lateness = []
+    ticker = threading.Thread(target=fan_out, args=(stop, lateness))
+    ticker.start()
+    time.sleep(0.2)
+    lateness.clear()
+
+    results, elapsed = storm(pool, logins, hashed)
+
+    stop.set()
+    ticker.join()
+    pool.close()
+
+    lateness = sorted(lateness)
+    p50 = statistics.median(lateness) * 1000
+    p99 = lateness[int(len(lateness) * 0.99) - 1] * 1000
+    worst = lateness[-1] * 1000
+    print(f"{name:>8}: storm {elapsed:6.2f}s  ok {results['ok']:4d}  busy {results['busy']:4d}  "
+          f"fan-out lateness p50 {p50:7.2f}ms  p99 {p99:7.2f}ms  max {worst:7.2f}ms")
+
+if __name__ == "__main__":
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    queue = int(sys.argv[3]) if len(sys.argv) > 3 else logins
+
+    hashed = hash_password("password1")
+    print(f"{logins} concurrent logins, {CLIENTS} clients per alert, tick {TICK*1000:.0f}ms")
+    run("inline", HashPool({"type":"inline"}), logins, hashed)
+    run("pool", HashPool({"type":"thread", "workers":workers, "queue":queue, "timeout":600}), logins, hashed)
@@ -0,0 +1,36 @@
+import sys
+import time
+
+from def_metrics import Histogram, instrument_event
+
+# Benchmark: per-call overhead of the metrics instrumentation
+# Times a trivial handler bare and wrapped by instrument_event, plus a
+# single Histogram.record, so the cost of leaving metrics on is visible
+#
+# Usage: python bench_metrics.py [calls]
+
+def handler(data):
+    return data
+
+@instrument_event("bench")
+def instrumented_handler(data):
+    return data
+
+def timed(name, calls, fn, *args):
+    started = time.perf_counter()
+    for n in range(calls):
+        fn(*args)
+    elapsed = time.perf_counter() - started
+    per_call = elapsed / calls * 1e9
+    print(f"{name:>22}: {per_call:8.0f}ns per call")
+    return per_call
+
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    histogram = Histogram("bench")
+    print(f"{calls} calls")
+    bare = timed("bare handler", calls, handler, {})
+    wrapped = timed("instrumented handler", calls, instrumented_handler, {})
+    timed("Histogram.record", calls, histogram.record, 0.0042)
+    print(f"{'overhead':>22}: {wrapped - bare:8.0f}ns per event")
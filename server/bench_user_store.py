@@ -0,0 +1,97 @@
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import os
+
+from def_utilities import local_file
+from def_stores import UserStore
+
+# Micro-benchmark: UserStore.get with a column projection vs the old
+# "SELECT *" lookup that rebuilt the column names on every call, and
+# commits per login with immediate vs deferred (write-behind) updates.
+# Logins are spread over distinct users and paced at a fixed rate, so the
+# deferred figure is what the flusher folds at that login rate, not one
+# user's updates merged into a single commit.
+#
+# Usage: python bench_user_store.py [calls] [logins] [logins per second]
+
+SESSION_FIELDS = ("id", "token", "role", "username", "icon", "color")
+
+# The lookup as it was before projections were supported
+def legacy_get(conn, id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM users WHERE id=?", (id,))
+    result = cursor.fetchone()
+    if result:
+        column_names = [description[0] for description in cursor.description]
+        return dict(zip(column_names, result))
+    else:
+        return None
+
+# Users the logins are spread over, added to the benchmark's copy of the database
+def add_users(users, count):
+    ids = []
+    for n in range(count):
+        id = "bench"+str(n).zfill(5)
+        users.set({ "id":id, "password":"", "role":10, "username":id })
+        ids.append(id)
+    return ids
+
+# Replay the user store writes of a login + connect + disconnect cycle,
+# each login by the next user and started on a fixed schedule
+def logins(users, ids, count, rate, defer):
+    started_commits = users.commits
+    busy = 0
+    started = time.perf_counter()
+    for n in range(count):
+        # Sleep until this login is due
+        delay = started + n / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        id = ids[n % len(ids)]
+        login_started = time.perf_counter()
+        users.edit(id, {"token":str(n), "last_login":str(n)}, defer=defer)
+        users.edit(id, {"last_connect":str(n)}, defer=defer)
+        users.edit(id, {"last_disconnect":str(n)}, defer=defer)
+        busy += time.perf_counter() - login_started
+    users.flush()
+    commits = users.commits - started_commits
+    mode = "deferred" if defer else "immediate"
+    print(f"{mode:>22}: {commits/count:7.3f} commits per login, {busy/count*1e6:9.2f}us per login")
+
+def timed(name, calls, fn):
+    started = time.perf_counter()
+    for n in range(calls):
+        fn()
+    elapsed = time.perf_counter() - started
+    print(f"{name:>22}: {elapsed/calls*1e6:7.2f}us per call")
+
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    rate = float(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    # Work on a copy so the benchmark never touches the real database
+    workdir = tempfile.mkdtemp()
+    source = os.path.join(workdir, "users.db")
+    shutil.copy(local_file("users.db"), source)
+
+    conn = sqlite3.connect(source, check_same_thread=False)
+    users = UserStore({ "source":source, "type":"sqlite" })
+
+    print(f"{calls} lookups of one user")
+    timed("legacy SELECT *", calls, lambda: legacy_get(conn, "user1"))
+    timed("get()", calls, lambda: users.get("user1"))
+    timed("get(SESSION_FIELDS)", calls, lambda: users.get("user1", fields=SESSION_FIELDS))
+    timed("get(('role',))", calls, lambda: users.get("user1", fields=("role",)))
+
+    ids = add_users(users, count)
+    print(f"{count} logins by {len(ids)} users, {rate:g} logins per second")
+    logins(users, ids, count, rate, False)
+    logins(users, ids, count, rate, True)
+
+    conn.close()
+    users.close()
+    shutil.rmtree(workdir)
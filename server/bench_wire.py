@@ -0,0 +1,96 @@
+import sys
+import json
+import time
+import uuid
+
+from def_wire import JsonEncoding, MsgpackEncoding, msgpack
+
+# Benchmark: bytes on the wire and encode/decode time per wire encoding
+# Payloads are a roster snapshot of N users, one alert fanned out to all
+# N clients and one presence delta (user_joined). JSON is sized as
+# Socket.IO sends it (compact separators), MessagePack with field tags.
+#
+# Usage: python bench_wire.py [users] [rounds]
+
+COLORS = ["lightgreen", "red", "purple", "blue", "yellow", None]
+GROUPS = ["ops", "site-north", "site-south", None]
+
+def roster(users):
+    return {
+        "epoch":uuid.uuid4().hex,
+        "version":users,
+        "users":{
+            uuid.uuid4().hex[:20]:{
+                "name":"user"+str(n).zfill(4),
+                "icon":None,
+                "color":COLORS[n % len(COLORS)],
+                "role":n % 10 + 1,
+                "group":GROUPS[n % len(GROUPS)],
+            }
+            for n in range(users)
+        },
+    }
+
+def alert():
+    return {
+        "text":"Code red in the server room, all hands",
+        "color":"red",
+        "username":"user0001",
+        "seq":123456,
+        "sent_at":time.time(),
+        "audio":"3f2a9c81d04e5b6a7c8d",
+    }
+
+def user_joined():
+    return {
+        "version":1001,
+        "id":uuid.uuid4().hex[:20],
+        "user":{ "name":"user1001", "icon":None, "color":"blue", "role":4, "group":"ops" },
+    }
+
+# JSON as Socket.IO serializes it
+class SocketIoJson(JsonEncoding):
+    def encode(self, data):
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, data):
+        return json.loads(data)
+
+def timed(encoding, data, rounds):
+    started = time.perf_counter()
+    for n in range(rounds):
+        encoded = encoding.encode(data)
+    encode_time = (time.perf_counter() - started) / rounds
+    started = time.perf_counter()
+    for n in range(rounds):
+        decoded = encoding.decode(encoded)
+    decode_time = (time.perf_counter() - started) / rounds
+    assert decoded == json.loads(json.dumps(data))
+    return len(encoded), encode_time, decode_time
+
+def report(name, data, encodings, rounds, fanout=1):
+    print(name)
+    sizes = {}
+    for encoding in encodings:
+        size, encode_time, decode_time = timed(encoding, data, rounds)
+        sizes[encoding.name] = size
+        # Broadcasts are encoded once per encoding, every client decodes its copy
+        print(f"{encoding.name:>10}: {size:9d} bytes, {size * fanout:11d} bytes to {fanout} clients, "
+            f"encode {encode_time * 1e6:9.1f}us, decode {decode_time * 1e6:9.1f}us")
+    if "msgpack" in sizes:
+        print(f"{'saved':>10}: {1 - sizes['msgpack'] / sizes['json']:9.0%}")
+
+if __name__ == "__main__":
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    encodings = [SocketIoJson()]
+    if msgpack is not None:
+        encodings.append(MsgpackEncoding())
+    else:
+        print("msgpack not installed (pip install msgpack), JSON only")
+
+    print(f"{users} users, {rounds} rounds")
+    report("roster snapshot", roster(users), encodings, max(1, rounds // 10))
+    report("alert fan-out", alert(), encodings, rounds, users)
+    report("user_joined fan-out", user_joined(), encodings, rounds, users)
@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import socket
+import struct
+import pickle
+import threading
+
+import socketio
+
+# Local stand-in for a Socket.IO message queue (redis, kafka, ...)
+# A broker process relays every frame it receives on a UNIX socket to every
+# connected server process, UnixSocketManager plugs that into python-socketio
+# so emit(..., broadcast=True) reaches clients attached to every process.
+#
+# Start the broker: python def_broker.py /tmp/manifest_broker.sock
+# then set MESSAGE_QUEUE to { "type":"unix", "path":"/tmp/manifest_broker.sock" }
+#
+# NOTE: Frames are pickled, the socket is created owner-only (0600, by umask
+# so it is never reachable by others, not even between bind and chmod) so
+# only processes of the same user can publish
+
+HEADER = struct.Struct("!I")
+
+def send_frame(sock, payload):
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+def recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError("broker connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def recv_frame(sock):
+    (size,) = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return recv_exact(sock, size)
+
+# Socket.IO client manager publishing through the UNIX socket broker
+class UnixSocketManager(socketio.PubSubManager):
+    name = "unix"
+
+    def __init__(self, path, channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.publisher = None
+        self.publish_lock = threading.Lock()
+
+    def connect_broker(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    def _publish(self, data):
+        payload = pickle.dumps(data)
+        with self.publish_lock:
+            for attempt in range(2):
+                try:
+                    if self.publisher is None:
+                        self.publisher = self.connect_broker()
+                    send_frame(self.publisher, payload)
+                    return
+                except OSError:
+                    # Broker restarted, reconnect once before giving up
+                    if self.publisher is not None:
+                        self.publisher.close()
+                    self.publisher = None
+                    if attempt:
+                        raise
+
+    def _listen(self):
+        delay = 1
+        while True:
+            try:
+                sock = self.connect_broker()
+                delay = 1
+                while True:
+                    yield pickle.loads(recv_frame(sock))
+            except OSError as e:
+                self._get_logger().error("Broker connection lost ("+str(e)+"), retrying in "+str(delay)+"s")
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+# Relay every frame from any connected process to all of them (sender included,
+# python-socketio delivers to its own clients when its message comes back)
+def run_broker(path):
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    previous = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(previous)
+    os.chmod(path, 0o600)
+    server.listen()
+
+    clients = {}
+    lock = threading.Lock()
+
+    def relay(conn):
+        try:
+            while True:
+                frame = recv_frame(conn)
+                with lock:
+                    targets = list(clients.items())
+                for target, send_lock in targets:
+                    try:
+                        with send_lock:
+                            send_frame(target, frame)
+                    except OSError:
+                        pass
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            with lock:
+                clients.pop(conn, None)
+            conn.close()
+
+    print("Broker listening on "+path)
+    while True:
+        conn, address = server.accept()
+        with lock:
+            clients[conn] = threading.Lock()
+        threading.Thread(target=relay, args=(conn,), daemon=True).start()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python def_broker.py <socket_path>")
+        sys.exit(1)
+
+    run_broker(sys.argv[1])
@@ -0,0 +1,97 @@
+import time
+import threading
+
+from def_metrics import ALERTS_RATE_LIMITED
+
+# Token bucket - "rate" tokens per second up to "burst", one token per action
+class TokenBucket():
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+# Per user and global alert rate limits
+# A user's bucket is only charged when the global bucket also has room, so
+# a user held back by the global limit keeps their own allowance
+class RateLimiter():
+    def __init__(self, limits):
+        self.user_rate = limits.get("user_rate", 0.5)
+        self.user_burst = limits.get("user_burst", 5)
+        self.idle = limits.get("idle", 600)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.pruned = time.monotonic()
+        self.everyone = TokenBucket(limits.get("global_rate", 2), limits.get("global_burst", 10), self.pruned)
+
+    # None when allowed, otherwise the limit that was hit ("user" or "global")
+    def allow(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = self.buckets[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+            if bucket.tokens + (now - bucket.updated) * bucket.rate < 1:
+                scope = "user"
+            elif not self.everyone.take(now):
+                scope = "global"
+            else:
+                bucket.take(now)
+                scope = None
+            if now - self.pruned > self.idle:
+                self.prune(now)
+        if scope is not None:
+            ALERTS_RATE_LIMITED.labels(scope).inc()
+        return scope
+
+    # Drop buckets that have refilled, they'd be recreated full anyway
+    def prune(self, now):
+        self.buckets = { user_id:bucket for user_id, bucket in self.buckets.items() if now - bucket.updated < self.idle }
+        self.pruned = now
+
+# Identical alerts within a window are folded into the first one
+# The first alert goes out straight away and opens the window, repeats
+# only bump a count, and when the window closes one more broadcast carries
+# the total so clients can show "(xN)" instead of N alarms
+class AlertCoalescer():
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.open_windows = {}
+        self.folded = 0
+
+    # True when the alert was folded into an open window
+    def fold(self, key):
+        if self.window <= 0:
+            return False
+        with self.lock:
+            if key not in self.open_windows:
+                return False
+            self.open_windows[key] += 1
+            self.folded += 1
+            return True
+
+    # Open a window for a broadcast alert, False if one raced us to it (alert is folded)
+    def open(self, key):
+        if self.window <= 0:
+            return True
+        with self.lock:
+            if key in self.open_windows:
+                self.open_windows[key] += 1
+                self.folded += 1
+                return False
+            self.open_windows[key] = 0
+            return True
+
+    # Close the window, returns how many repeats were folded into it
+    def close(self, key):
+        with self.lock:
+            return self.open_windows.pop(key, 0)
@@ -0,0 +1,161 @@
+import sys
+import json
+import queue
+import logging
+import itertools
+
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timezone
+
+# Structured logging off the request path
+# Handlers only build a record and put it on a bounded queue, a listener
+# thread formats it as one JSON object per line and does the actual write,
+# so a burst of connects never waits on the console or disk.
+#
+# Usage:
+#   log = get_logger("app")
+#   log.info("login", user_id=user_id, result="success")
+# writes
+#   {"ts":"...","level":"INFO","logger":"manifest.app","event":"login","user_id":"user1","result":"success"}
+
+LEVELS = { "DEBUG":logging.DEBUG, "INFO":logging.INFO, "WARNING":logging.WARNING, "ERROR":logging.ERROR }
+REDACTED = "[redacted]"
+
+# Set by setup_logging
+handler = None
+listener = None
+sample_rates = {}
+sample_counters = {}
+
+# Write one JSON object per line, values of sensitive keys are replaced
+class JsonFormatter(logging.Formatter):
+    def __init__(self, redact):
+        super().__init__()
+        self.redact = tuple(name.lower() for name in redact)
+
+    def sensitive(self, key):
+        key = str(key).lower()
+        return any(name in key for name in self.redact)
+
+    def scrub(self, value):
+        if isinstance(value, dict):
+            return { key:(REDACTED if self.sensitive(key) else self.scrub(item)) for key, item in value.items() }
+        if isinstance(value, (list, tuple)):
+            return [self.scrub(item) for item in value]
+        return value
+
+    def format(self, record):
+        entry = {
+            "ts":datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level":record.levelname,
+            "logger":record.name,
+            "event":record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(self.scrub(fields))
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, separators=(",", ":"))
+
+# Queue handler that never blocks the caller
+# Formatting is left to the listener thread and records are dropped (and
+# counted) rather than waiting when the queue is full
+class AsyncQueueHandler(QueueHandler):
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Tracebacks can't wait, the frames will be gone by the time the listener runs
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# Logger taking an event name and keyword fields
+# Level and sampling are checked before a record is built, so a filtered
+# out event costs a dict lookup, and records skip the caller lookup
+# (a stack walk) that Logger.log does
+class EventLogger():
+    def __init__(self, name):
+        self.logger = logging.getLogger("manifest."+name)
+
+    def log(self, level, event, fields, exc_info=False):
+        if not self.logger.isEnabledFor(level):
+            return
+        every = sample_rates.get(event)
+        if every:
+            # Keep one in every "every" records, the field lets readers scale counts back up
+            if next(sample_counters[event]) % every:
+                return
+            fields["sample"] = every
+        if exc_info:
+            exc_info = sys.exc_info()
+        record = self.logger.makeRecord(self.logger.name, level, "", 0, event, (), exc_info or None, extra={ "fields":fields })
+        self.logger.handle(record)
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, fields)
+
+    # Error with the current exception's traceback
+    def exception(self, event, **fields):
+        self.log(logging.ERROR, event, fields, exc_info=True)
+
+def get_logger(name):
+    return EventLogger(name)
+
+# Route every "manifest.*" logger through the queue
+def setup_logging(options):
+    global handler, listener, sample_rates, sample_counters
+
+    if options.get("file"):
+        output = logging.FileHandler(options["file"], encoding="utf-8")
+    else:
+        output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter(options.get("redact", ["password", "token"])))
+
+    handler = AsyncQueueHandler(queue.Queue(options.get("queue_size", 10000)))
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+
+    # Thread and process names aren't written, don't look them up for every record
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    root = logging.getLogger("manifest")
+    root.handlers = [handler]
+    root.propagate = False
+    root.setLevel(LEVELS[options.get("level", "INFO")])
+    for name, level in options.get("levels", {}).items():
+        logging.getLogger("manifest."+name).setLevel(LEVELS[level])
+
+    sample_rates = { event:int(every) for event, every in options.get("sample", {}).items() if int(every) > 1 }
+    sample_counters = { event:itertools.count() for event in sample_rates }
+    return handler
+
+# Write out what is still queued
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+def dropped():
+    return handler.dropped if handler is not None else 0
@@ -0,0 +1,272 @@
+import time
+import bisect
+import threading
+import functools
+
+from collections import OrderedDict
+
+# Latency histogram with fixed log-spaced buckets
+# Recording is a bucket increment, percentiles are read back from the bucket
+# counts so memory stays constant no matter how many samples are recorded
+class Histogram():
+    # Upper bounds in seconds, 10us to ~100s, 4 buckets per factor of 10
+    BOUNDS = tuple(10 ** (exponent / 4) for exponent in range(-20, 9))
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(self.BOUNDS) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.max = 0.0
+
+    def record(self, value):
+        index = bisect.bisect_left(self.BOUNDS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    # Upper bound of the bucket holding the q-th sample (0 < q <= 1), capped at the max seen
+    def percentile(self, q):
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    if index == len(self.BOUNDS):
+                        return self.max
+                    return min(self.BOUNDS[index], self.max)
+            return self.max
+
+    def summary(self):
+        return {
+            "count":self.count,
+            "mean":self.sum / self.count if self.count else 0.0,
+            "p50":self.percentile(0.5),
+            "p99":self.percentile(0.99),
+            "max":self.max,
+        }
+
+# Monotonic counter
+class Counter():
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+# A metric split by one label, children are created on first use
+class Family():
+    def __init__(self, kind, name, help, label, factory):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label = label
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, value):
+        child = self.children.get(value)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(value, self.factory(self.name))
+        return child
+
+# Collection of metrics rendered in the Prometheus text format
+class Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, label):
+        family = Family("counter", name, help, label, Counter)
+        self.metrics.append(family)
+        return family
+
+    def histogram(self, name, help, label):
+        family = Family("histogram", name, help, label, Histogram)
+        self.metrics.append(family)
+        return family
+
+    # Counter read from the sample counts of a histogram family, costs nothing to record
+    def count_of(self, name, help, histograms):
+        self.metrics.append(("count_of", name, help, histograms))
+
+    # Register an existing unlabelled histogram
+    def add_histogram(self, histogram, help):
+        self.metrics.append(("histogram", histogram, help))
+        return histogram
+
+    # Value read when the metrics are scraped, kind is "gauge" or "counter"
+    def callback(self, kind, name, help, fn):
+        self.metrics.append((kind, name, help, fn))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            if isinstance(metric, Family):
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                for value, child in sorted(metric.children.items()):
+                    labels = f'{metric.label}="{escape_label(value)}"'
+                    if metric.kind == "counter":
+                        lines.append(f"{metric.name}{{{labels}}} {child.value}")
+                    else:
+                        render_histogram(lines, metric.name, child, labels)
+            elif metric[0] == "count_of":
+                kind, name, help, histograms = metric
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} counter")
+                for value, child in sorted(histograms.children.items()):
+                    lines.append(f'{name}{{{histograms.label}="{escape_label(value)}"}} {child.count}')
+            elif metric[0] == "histogram":
+                kind, histogram, help = metric
+                lines.append(f"# HELP {histogram.name} {help}")
+                lines.append(f"# TYPE {histogram.name} histogram")
+                render_histogram(lines, histogram.name, histogram, "")
+            else:
+                kind, name, help, fn = metric
+                try:
+                    value = fn()
+                except Exception:
+                    continue
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_histogram(lines, name, histogram, labels):
+    with histogram.lock:
+        counts = list(histogram.counts)
+        count = histogram.count
+        total = histogram.sum
+    separator = "," if labels else ""
+    cumulative = 0
+    for bound, bucket in zip(Histogram.BOUNDS, counts):
+        cumulative += bucket
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{bound:.6g}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {count}')
+    suffix = "{"+labels+"}" if labels else ""
+    lines.append(f"{name}_sum{suffix} {total}")
+    lines.append(f"{name}_count{suffix} {count}")
+
+REGISTRY = Registry()
+EVENT_SECONDS = REGISTRY.histogram("manifest_socket_event_seconds", "Socket.IO event handling time", "event")
+REGISTRY.count_of("manifest_socket_events_total", "Socket.IO events handled", EVENT_SECONDS)
+EVENT_ERRORS = REGISTRY.counter("manifest_socket_event_errors_total", "Socket.IO events that raised", "event")
+ROUTE_SECONDS = REGISTRY.histogram("manifest_http_request_seconds", "HTTP request handling time", "route")
+REGISTRY.count_of("manifest_http_requests_total", "HTTP requests handled", ROUTE_SECONDS)
+ROUTE_ERRORS = REGISTRY.counter("manifest_http_request_errors_total", "HTTP requests that raised or answered 4xx/5xx", "route")
+BCRYPT_SECONDS = REGISTRY.histogram("manifest_bcrypt_seconds", "Time spent hashing or checking passwords", "op")
+SQLITE_SECONDS = REGISTRY.histogram("manifest_sqlite_query_seconds", "Time spent in sqlite reads and writes", "store")
+SQLITE_COMMITS = REGISTRY.counter("manifest_sqlite_commits_total", "sqlite commits", "store")
+ALERTS_RATE_LIMITED = REGISTRY.counter("manifest_alerts_rate_limited_total", "Alerts refused by a rate limit", "scope")
+
+# Time and count errors of a handler, labels are resolved once here so each
+# call only costs two clock reads and one histogram record (calls are the
+# histogram's sample count)
+def instrument(seconds, errors, name, failed=None):
+    errors = errors.labels(name)
+    seconds = seconds.labels(name)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                seconds.record(time.perf_counter() - started)
+            if failed is not None and failed(result):
+                errors.inc()
+            return result
+        return wrapper
+    return decorator
+
+def instrument_event(name):
+    return instrument(EVENT_SECONDS, EVENT_ERRORS, name)
+
+# Flask views answer errors as (body, status) tuples rather than raising
+def error_response(result):
+    return isinstance(result, tuple) and len(result) > 1 and isinstance(result[1], int) and result[1] >= 400
+
+def instrument_route(name):
+    return instrument(ROUTE_SECONDS, ROUTE_ERRORS, name, error_response)
+
+# Alerts in flight, so client acknowledgements can be turned into latencies
+#   fanout   - time spent in the broadcast emit on the server
+#   delivery - send to acknowledgement received, an upper bound on the time
+#              until clients showed the alert (includes the ack's trip back)
+#   display  - client reported time from receiving the alert to showing it
+#   audio    - client reported time from receiving the alert to the first klaxon sample
+class DeliveryTracker():
+    def __init__(self, size=1000):
+        self.size = size
+        self.sent = OrderedDict()
+        self.lock = threading.Lock()
+        self.fanout = Histogram("manifest_alert_fanout_seconds")
+        self.delivery = Histogram("manifest_alert_delivery_seconds")
+        self.display = Histogram("manifest_alert_display_seconds")
+        self.audio = Histogram("manifest_alert_audio_seconds")
+        self.acks = 0
+        self.unknown_acks = 0
+
+    def sent_alert(self, seq, started):
+        now = time.perf_counter()
+        self.fanout.record(now - started)
+        with self.lock:
+            self.sent[seq] = started
+            while len(self.sent) > self.size:
+                self.sent.popitem(last=False)
+
+    def acked(self, seq, display_delay, audio_delay=None):
+        now = time.perf_counter()
+        with self.lock:
+            started = self.sent.get(seq)
+            if started is None:
+                # Too old, or not an alert we sent
+                self.unknown_acks += 1
+                return
+            self.acks += 1
+        self.delivery.record(now - started)
+        if isinstance(display_delay, (int, float)) and 0 <= display_delay < 3600:
+            self.display.record(display_delay)
+        if isinstance(audio_delay, (int, float)) and 0 <= audio_delay < 3600:
+            self.audio.record(audio_delay)
+
+    def summary(self):
+        return {
+            "acks":self.acks,
+            "unknown_acks":self.unknown_acks,
+            "fanout":self.fanout.summary(),
+            "delivery":self.delivery.summary(),
+            "display":self.display.summary(),
+            "audio":self.audio.summary(),
+        }
+
+    # Expose the latency histograms on a registry
+    def register(self, registry):
+        registry.add_histogram(self.fanout, "Time spent broadcasting an alert")
+        registry.add_histogram(self.delivery, "Alert send to client acknowledgement")
+        registry.add_histogram(self.display, "Client reported alert receive to display time")
+        registry.add_histogram(self.audio, "Client reported alert receive to first klaxon sample time")
+        registry.callback("counter", "manifest_alert_acks_total", "Alert acknowledgements received", lambda: self.acks)
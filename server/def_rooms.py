@@ -0,0 +1,58 @@
+# Socket.IO rooms derived from user attributes
+# Each validated connection joins one room for its role and one for its
+# group, a targeted alert is emitted to the rooms of its audience so only
+# those connections are visited instead of every socket on the server.
+#
+# Audience, as sent with send_alert (all keys optional, none means everyone):
+#   { "roles":[2, 4], "max_role":3, "groups":["ops", "site-north"] }
+# "max_role" is a role tier - that role and every more privileged one (lower number)
+
+MAX_ROLE = 100
+
+def role_room(role):
+    return "role:"+str(role)
+
+def group_room(group):
+    return "group:"+str(group)
+
+# Rooms a user's connections belong to
+def user_rooms(user):
+    rooms = []
+    if user.get("role") is not None:
+        rooms.append(role_room(user.get("role")))
+    if user.get("group"):
+        rooms.append(group_room(user.get("group")))
+    return rooms
+
+# Rooms of an audience, None for everyone
+# Raises ValueError for a malformed audience
+def audience_rooms(audience):
+    if not audience:
+        return None
+    if not isinstance(audience, dict):
+        raise ValueError("Audience must be an object")
+    unknown = set(audience.keys()) - {"roles", "max_role", "groups"}
+    if unknown:
+        raise ValueError("Unknown audience field "+sorted(unknown)[0])
+
+    rooms = set()
+    for field in ("roles", "groups"):
+        if audience.get(field) is not None and not isinstance(audience.get(field), (list, tuple)):
+            raise ValueError("Audience "+field+" must be a list")
+    for role in audience.get("roles") or []:
+        if not isinstance(role, int) or isinstance(role, bool):
+            raise ValueError("Audience roles must be numbers")
+        rooms.add(role_room(role))
+    max_role = audience.get("max_role")
+    if max_role is not None:
+        if not isinstance(max_role, int) or isinstance(max_role, bool) or not 1 <= max_role <= MAX_ROLE:
+            raise ValueError("Audience max_role must be a number from 1 to "+str(MAX_ROLE))
+        rooms.update(role_room(role) for role in range(1, max_role + 1))
+    for group in audience.get("groups") or []:
+        if not isinstance(group, str) or not group:
+            raise ValueError("Audience groups must be names")
+        rooms.add(group_room(group))
+    if not rooms:
+        raise ValueError("Audience has no roles or groups")
+    # Sorted so the same audience always gives the same key
+    return tuple(sorted(rooms))
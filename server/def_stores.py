@@ -2,9 +2,22 @@ import sys
 import os
 import sqlite3
 import json
+import time
+import hashlib
+import uuid
+import threading
+
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 from pypref import Preferences
 
+from def_utilities import offload
+from def_metrics import SQLITE_SECONDS, SQLITE_COMMITS
+from def_logging import get_logger
+
+log = get_logger("stores")
+
 if getattr(sys, 'frozen', False):
     # If the application is run as a bundle, the PyInstaller bootloader
     # extends the sys module by a flag frozen=True and sets the app 
@@ -17,6 +30,11 @@ else:
 def local_file(filename):
     return os.path.join(application_path, filename)
 
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+# Columns added to the users table since it was first created, older databases get them on start
+USER_COLUMNS_ADDED = (("group", "TEXT"),)
+
 # Simple data store model
 # Scale this with more appropriate data storage
 class SimpleStore():
@@ -25,6 +43,8 @@ class SimpleStore():
         self.source = store.get("source")
         self.type = store.get("type")
         self.conn = None
+        self.journal = None
+        self.lock = threading.Lock()
         if self.type == "dict":
             if self.source:
                 self.data = self.source #dict
@@ -33,8 +53,14 @@ class SimpleStore():
         elif self.type == "py":
             self.data = Preferences(filename=self.source)
         elif self.type == "json":
-            with open(local_file(self.source), 'r') as f:
-                self.data = json.load(f)
+            if os.path.exists(local_file(self.source)):
+                with open(local_file(self.source), 'r') as f:
+                    self.data = json.load(f)
+            else:
+                self.data = {}
+            if store.get("journal"):
+                # Append changes to a journal instead of rewriting the whole file
+                self.journal = JsonJournal(self, store)
 
     def connected(self):
         return True
@@ -55,6 +81,11 @@ class SimpleStore():
         elif self.type == "json":
             return self.data.get(key)
 
+    def size(self):
+        if self.type == "py":
+            return len(self.data.preferences)
+        return len(self.data)
+
     def set(self, key, value):
         if self.type == "dict":
             self.data[key] = value
@@ -63,10 +94,9 @@ class SimpleStore():
             update[key] = value
             self.data.update_preferences(update)
         elif self.type == "json":
-            self.data[key] = value
-            json_object = json.dumps(self.data, indent=0)
-            with open(local_file(self.source), "w") as f:
-                f.write(json_object)
+            with self.lock:
+                self.data[key] = value
+                self.persist({ "op":"set", "key":key, "value":value })
     
     def rem(self, key):
         if self.type == "dict":
@@ -76,10 +106,9 @@ class SimpleStore():
             update[key] = None
             self.data.update_preferences(update)
         elif self.type == "json":
-            self.data.pop(key,None)
-            json_object = json.dumps(self.data, indent=0)
-            with open(local_file(self.source), "w") as f:
-                f.write(json_object)
+            with self.lock:
+                self.data.pop(key,None)
+                self.persist({ "op":"rem", "key":key })
 
     def edit(self, key, new_data):
         if self.type == "dict":
@@ -89,76 +118,1167 @@ class SimpleStore():
             update[key] = new_data
             self.data.update_preferences(update)
         elif self.type == "json":
-            data = self.data.get(key)
-            data.update(new_data)
-            self.data[key] = data
-            json_object = json.dumps(self.data, indent=0)
-            with open(local_file(self.source), "w") as f:
-                f.write(json_object)
+            with self.lock:
+                data = self.data.get(key)
+                data.update(new_data)
+                self.data[key] = data
+                self.persist({ "op":"edit", "key":key, "value":new_data })
+
+    # Write a json store change, caller holds self.lock
+    def persist(self, change):
+        if self.journal is not None:
+            self.journal.append(change)
+        else:
+            self.write_snapshot(json.dumps(self.data, indent=0))
+
+    def write_snapshot(self, json_object):
+        with open(local_file(self.source), "w") as f:
+            f.write(json_object)
 
     def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
         return True
 
+# Append-only journal for a json SimpleStore
+# Each change is one json line in "<source>.journal". A background thread
+# fsyncs the journal every "fsync_interval" seconds (group commit) and folds
+# it back into the store file once it holds "compact_every" changes.
+# On startup the store file is loaded and any journal is replayed over it.
+class JsonJournal():
+    def __init__(self, store, options):
+        self.store = store
+        self.path = local_file(store.source) + ".journal"
+        self.old_path = self.path + ".old"
+        self.fsync_interval = options.get("fsync_interval", 0.05)
+        self.compact_every = options.get("compact_every", 10000)
+        self.entries = 0
+        self.dirty = False
+        self.snapshot = None
+        self.closed = threading.Event()
+
+        # Crash recovery - a compaction may have been interrupted part way
+        replayed = self.replay(self.old_path) + self.replay(self.path)
+        self.file = open(self.path, "a", encoding="utf-8")
+        if replayed or os.path.exists(self.old_path):
+            self.compact()
+
+        self.flusher = threading.Thread(target=self.run, name="journal-flush", daemon=True)
+        self.flusher.start()
+
+    # Apply journal lines to the store data, dropping a torn final line
+    def replay(self, path):
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        good = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    break
+                self.apply(change)
+                good += len(line)
+                count += 1
+        with open(path, "rb+") as f:
+            f.truncate(good)
+        return count
+
+    def apply(self, change):
+        data = self.store.data
+        key = change.get("key")
+        if change.get("op") == "set":
+            data[key] = change.get("value")
+        elif change.get("op") == "rem":
+            data.pop(key, None)
+        elif change.get("op") == "edit":
+            value = data.get(key) or {}
+            value.update(change.get("value"))
+            data[key] = value
+
+    # Caller holds the store lock
+    def append(self, change):
+        self.file.write(json.dumps(change, separators=(",", ":")) + "\n")
+        self.entries += 1
+        if self.fsync_interval:
+            self.dirty = True
+        else:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        offload(os.fsync, self.file.fileno())
+        self.dirty = False
+
+    def run(self):
+        while not self.closed.wait(self.fsync_interval or 1):
+            with self.store.lock:
+                if self.dirty:
+                    self.sync()
+                if self.entries >= self.compact_every:
+                    self.rotate()
+                else:
+                    continue
+            self.compact_old()
+
+    # Snapshot the data and start a fresh journal, caller holds the store lock
+    def rotate(self):
+        self.snapshot = json.dumps(self.store.data, indent=0)
+        self.sync()
+        self.file.close()
+        os.replace(self.path, self.old_path)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.entries = 0
+
+    # Write the snapshot outside the lock, then drop the rotated journal
+    def compact_old(self):
+        tmp = local_file(self.store.source) + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, local_file(self.store.source))
+        os.remove(self.old_path)
+        self.snapshot = None
+
+    def compact(self):
+        with self.store.lock:
+            self.rotate()
+        self.compact_old()
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        self.compact()
+        self.file.close()
+
+# Users in sqlite behind a small connection pool
+# WAL mode lets readers carry on while a login is writing, writers wait up
+# to "busy_timeout" ms for the lock and are retried "retries" times after that
 class UserStore():
     def __init__(self, store):
         self.source = store.get("source")
         self.type = store.get("type")
-        self.conn = sqlite3.connect(local_file(self.source), check_same_thread=False)
+        self.pool_size = store.get("pool_size", 4)
+        self.journal_mode = store.get("journal_mode", "WAL").upper()
+        self.synchronous = store.get("synchronous", "NORMAL").upper()
+        self.busy_timeout = store.get("busy_timeout", 5000)
+        self.retries = store.get("retries", 3)
+        self.retry_delay = store.get("retry_delay", 0.05)
+        self.query_seconds = SQLITE_SECONDS.labels("users")
+        self.commit_count = SQLITE_COMMITS.labels("users")
+        self.flush_interval = store.get("flush_interval", 0.01)
+        if self.journal_mode not in JOURNAL_MODES:
+            raise ValueError("Unknown journal_mode "+self.journal_mode)
+        if self.synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError("Unknown synchronous level "+self.synchronous)
+
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.waiting = 0
+        self.idle = []
+        self.connections = []
+        self.conn = self.connect()
+        # Journal mode is stored in the database file, set it once
+        self.conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        self.migrate()
+        self.columns = tuple(row[1] for row in self.conn.execute("PRAGMA table_info(users)"))
+        # SELECT text per projection, reusing the text lets sqlite reuse the prepared statement
+        self.statements = {}
+        self.idle.append(self.conn)
+
+        # Write-behind queue - deferred column updates per user id, merged
+        # until the flusher commits them together in one transaction
+        self.commits = 0
+        self.pending = {}
+        self.flushing = {}
+        self.pending_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.run, name="user-flush", daemon=True)
+        self.flusher.start()
+
+    def connect(self):
+        conn = sqlite3.connect(
+            local_file(self.source),
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False
+        )
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        self.connections.append(conn)
+        return conn
+
+    # Borrow a connection from the pool, opening a new one while below pool_size
+    # NOTE: The uncontended path is a bare list pop, no locking
+    def acquire(self):
+        try:
+            return self.idle.pop()
+        except IndexError:
+            pass
+        with self.available:
+            self.waiting += 1
+            try:
+                while True:
+                    # The unlocked path can take a released connection between our check and pop
+                    try:
+                        return self.idle.pop()
+                    except IndexError:
+                        pass
+                    if len(self.connections) < self.pool_size:
+                        return self.connect()
+                    if not self.available.wait(self.busy_timeout / 1000):
+                        raise sqlite3.OperationalError("database is busy, no free connection")
+            finally:
+                self.waiting -= 1
+
+    def release(self, conn):
+        self.idle.append(conn)
+        if self.waiting:
+            with self.available:
+                self.available.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def commit_write(self, conn, sql, values):
+        started = time.perf_counter()
+        try:
+            conn.execute(sql, values)
+            conn.commit()
+        finally:
+            self.query_seconds.record(time.perf_counter() - started)
+        self.commit_count.inc()
+
+    # Run a write and commit it, retrying when the database stays locked
+    def write(self, sql, values):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as conn:
+                    offload(self.commit_write, conn, sql, values)
+                self.commits += 1
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay * (attempt + 1))
 
     def connected(self):
         return self.conn is not None
             
-    def get(self, id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE id=?", (id,))
-        result = cursor.fetchone()
+    # Add the columns of USER_COLUMNS_ADDED missing from an older users table
+    def migrate(self):
+        existing = set(row[1] for row in self.conn.execute("PRAGMA table_info(users)"))
+        for column, kind in USER_COLUMNS_ADDED:
+            if column in existing:
+                continue
+            try:
+                self.conn.execute(f'ALTER TABLE users ADD COLUMN "{column}" {kind}')
+            except sqlite3.OperationalError as e:
+                # Another server process added it first
+                if "duplicate column" not in str(e):
+                    raise
+        self.conn.commit()
+
+    # Build (and remember) the SELECT for a set of columns
+    def statement(self, fields):
+        sql = self.statements.get(fields)
+        if sql is None:
+            for field in fields:
+                if field not in self.columns:
+                    raise ValueError("Unknown user field "+str(field))
+            columns = ", ".join(f'"{field}"' for field in fields)
+            sql = f"SELECT {columns} FROM users WHERE id=?"
+            self.statements[fields] = sql
+        return sql
+
+    # Return the user as a dict, optionally with only the requested fields
+    def get(self, id, fields=None):
+        fields = self.columns if fields is None else tuple(fields)
+        sql = self.statements.get(fields) or self.statement(fields)
+        conn = self.acquire()
+        started = time.perf_counter()
+        try:
+            result = conn.execute(sql, (id,)).fetchone()
+        finally:
+            self.query_seconds.record(time.perf_counter() - started)
+            self.release(conn)
         if result:
-            column_names = [description[0] for description in cursor.description]
-            return dict(zip(column_names, result))
+            user = dict(zip(fields, result))
+            # Deferred updates not yet committed still count
+            if id in self.flushing or id in self.pending:
+                self.overlay(id, user)
+            return user
         else:
             return None
 
+    def overlay(self, id, user):
+        with self.pending_lock:
+            for changes in (self.flushing.get(id), self.pending.get(id)):
+                if changes:
+                    for key, value in changes.items():
+                        if key in user:
+                            user[key] = value
+
+    # Forget deferred updates that a direct write supersedes
+    # Callers hold flush_lock, so no batch taken before the direct write can commit after it
+    def discard(self, id, keys=None):
+        with self.pending_lock:
+            changes = self.pending.get(id)
+            if changes is None:
+                return
+            if keys is None:
+                del self.pending[id]
+                return
+            for key in keys:
+                changes.pop(key, None)
+            if not changes:
+                del self.pending[id]
+
     def set(self, user_data):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (
-                id, password, role, username, icon, color, token,
-                last_login, last_connect, last_disconnect
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_data.get("id"),
-            user_data.get("password"),
-            user_data.get("role"),
-            user_data.get("username"),
-            user_data.get("icon"),
-            user_data.get("color"),
-            user_data.get("token"),
-            user_data.get("last_login"),
-            user_data.get("last_connect"),
-            user_data.get("last_disconnect")
-        ))
-        self.conn.commit()
+        with self.flush_lock:
+            self.discard(user_data.get("id"))
+            self.write('''
+                INSERT OR REPLACE INTO users (
+                    id, password, role, username, icon, color, token,
+                    last_login, last_connect, last_disconnect, "group"
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                user_data.get("id"),
+                user_data.get("password"),
+                user_data.get("role"),
+                user_data.get("username"),
+                user_data.get("icon"),
+                user_data.get("color"),
+                user_data.get("token"),
+                user_data.get("last_login"),
+                user_data.get("last_connect"),
+                user_data.get("last_disconnect"),
+                user_data.get("group")
+            ))
 
     def rem(self, id):
-        cursor = self.conn.cursor()
-        cursor.execute("DELETE FROM users WHERE id=?", (id,))
-        self.conn.commit()
+        with self.flush_lock:
+            self.discard(id)
+            self.write("DELETE FROM users WHERE id=?", (id,))
+
+    # Update columns of a user
+    # defer=True queues the update for the next batched commit - use it for
+    # columns that can stand to lose a few ms on a crash (tokens, timestamps),
+    # never for passwords or roles
+    def edit(self, id, new_data, defer=False):
+        if not new_data:
+            raise ValueError("No fields to edit")
+        for key in new_data.keys():
+            if key not in self.columns:
+                raise ValueError("Unknown user field "+str(key))
+
+        if defer:
+            with self.pending_lock:
+                self.pending.setdefault(id, {}).update(new_data)
+            return
 
-    def edit(self, id, new_data):
-        cursor = self.conn.cursor()
+        with self.flush_lock:
+            self.discard(id, new_data.keys())
+            self.write(*self.update_statement(id, new_data))
 
+    def update_statement(self, id, new_data):
         # Generate the SQL statement
-        columns = ", ".join(f"{key}=?" for key in new_data.keys())
+        columns = ", ".join(f'"{key}"=?' for key in new_data.keys())
         sql = f"UPDATE users SET {columns} WHERE id=?"
 
         # Prepare the values for the SQL statement
         values = list(new_data.values())
         values.append(id)
+        return sql, tuple(values)
 
-        # Execute the SQL statement
-        cursor.execute(sql, tuple(values))
-        self.conn.commit()
+    # Commit every deferred update in one transaction
+    def flush(self):
+        with self.flush_lock:
+            with self.pending_lock:
+                if not self.pending:
+                    return 0
+                self.flushing = self.pending
+                self.pending = {}
+            batch = self.flushing
+            try:
+                self.write_batch(batch)
+            except sqlite3.Error:
+                # Put the batch back under anything queued since, and retry next round
+                with self.pending_lock:
+                    for id, new_data in batch.items():
+                        merged = dict(new_data)
+                        merged.update(self.pending.get(id, {}))
+                        self.pending[id] = merged
+                    self.flushing = {}
+                raise
+            with self.pending_lock:
+                self.flushing = {}
+            return len(batch)
+
+    def commit_batch(self, conn, batch):
+        started = time.perf_counter()
+        try:
+            for id, new_data in batch.items():
+                conn.execute(*self.update_statement(id, new_data))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            self.query_seconds.record(time.perf_counter() - started)
+        self.commit_count.inc()
+
+    def write_batch(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as conn:
+                    offload(self.commit_batch, conn, batch)
+                self.commits += 1
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay * (attempt + 1))
+
+    def run(self):
+        while not self.closed.wait(self.flush_interval):
+            if self.pending:
+                try:
+                    self.flush()
+                except sqlite3.Error as e:
+                    log.error("user_store_flush_failed", error=str(e))
+
+    def stats(self):
+        return {
+            "connections":len(self.connections),
+            "commits":self.commits,
+            "pending":len(self.pending),
+        }
 
     def close(self):
-        self.conn.close()
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
         self.conn = None
+
+# Session tokens in sqlite with an expiry
+# Lookups are a single primary key read, expired tokens are deleted in
+# batches by a background sweeper so the table stays bounded
+class TokenStore():
+    def __init__(self, store):
+        self.source = store.get("source")
+        self.type = store.get("type")
+        self.ttl = store.get("ttl", 604800)
+        self.sweep_interval = store.get("sweep_interval", 60)
+        self.sweep_batch = store.get("sweep_batch", 500)
+        self.busy_timeout = store.get("busy_timeout", 5000)
+        self.query_seconds = SQLITE_SECONDS.labels("tokens")
+        self.commit_count = SQLITE_COMMITS.labels("tokens")
+        self.lock = threading.Lock()
+        # Wait for another writer's lock instead of failing with "database is locked"
+        self.conn = sqlite3.connect(local_file(self.source), timeout=self.busy_timeout / 1000, check_same_thread=False)
+        self.conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS tokens (
+                token TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                issued REAL NOT NULL,
+                expires REAL NOT NULL
+            )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tokens_expires ON tokens (expires, issued)")
+        self.conn.commit()
+        self.purged = 0
+
+        self.closed = threading.Event()
+        self.sweeper = threading.Thread(target=self.sweep, name="token-sweeper", daemon=True)
+        self.sweeper.start()
+
+    def connected(self):
+        return self.conn is not None
+
+    def get(self, token):
+        with self.lock:
+            started = time.perf_counter()
+            cursor = self.conn.execute("SELECT user_id FROM tokens WHERE token=? AND expires>?", (token, time.time()))
+            result = cursor.fetchone()
+            self.query_seconds.record(time.perf_counter() - started)
+        if result:
+            return result[0]
+        return None
+
+    def set(self, token, user_id):
+        issued = time.time()
+        with self.lock:
+            offload(self.commit,
+                "INSERT OR REPLACE INTO tokens (token, user_id, issued, expires) VALUES (?, ?, ?, ?)",
+                (token, user_id, issued, issued + self.ttl)
+            )
+
+    def rem(self, token):
+        if token is None:
+            return
+        with self.lock:
+            offload(self.commit, "DELETE FROM tokens WHERE token=?", (token,))
+
+    # Run a write and commit it, caller holds self.lock
+    def commit(self, sql, values):
+        started = time.perf_counter()
+        try:
+            cursor = self.conn.execute(sql, values)
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        self.query_seconds.record(time.perf_counter() - started)
+        self.commit_count.inc()
+        return cursor
+
+    # Delete expired tokens one batch per transaction so writers aren't held up
+    def purge(self):
+        total = 0
+        while not self.closed.is_set():
+            with self.lock:
+                cursor = offload(self.commit, '''
+                    DELETE FROM tokens WHERE token IN (
+                        SELECT token FROM tokens WHERE expires<=? LIMIT ?
+                    )
+                ''', (time.time(), self.sweep_batch))
+            total += cursor.rowcount
+            if cursor.rowcount < self.sweep_batch:
+                break
+        self.purged += total
+        return total
+
+    def sweep(self):
+        while not self.closed.wait(self.sweep_interval):
+            try:
+                self.purge()
+            except sqlite3.Error as e:
+                log.error("token_sweep_failed", error=str(e))
+
+    def size(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+
+    def reset(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM tokens")
+            self.conn.commit()
+
+    def close(self):
+        self.closed.set()
+        self.sweeper.join()
+        with self.lock:
+            self.conn.close()
+            self.conn = None
+
+# In-memory cache of authenticated sessions keyed by token
+# Entries expire after "ttl" seconds and the least recently used are evicted past "size"
+# With "enabled" false nothing is cached and every lookup goes to the stores
+class SessionCache():
+    def __init__(self, store):
+        self.enabled = store.get("enabled", True)
+        self.ttl = store.get("ttl", 60)
+        self.size = store.get("size", 10000)
+        self.data = OrderedDict()
+        # Tokens cached per user id, so user edits can invalidate every session of a user
+        self.owners = {}
+        # Invalidations per user id - a lookup takes the generation before reading
+        # the user and set() refuses the row if the user was invalidated meanwhile
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token):
+        with self.lock:
+            entry = self.data.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, user = entry
+            if expires < time.monotonic():
+                self._drop(token)
+                self.misses += 1
+                return None
+            self.data.move_to_end(token)
+            self.hits += 1
+            return user
+
+    def generation(self, user_id):
+        with self.lock:
+            return self.generations.get(user_id, 0)
+
+    # Cache a session read at "generation" (None to skip the check)
+    def set(self, token, user, generation=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            if generation is not None and self.generations.get(user.get("id"), 0) != generation:
+                return
+            self._drop(token)
+            self.data[token] = (time.monotonic() + self.ttl, user)
+            self.owners.setdefault(user.get("id"), set()).add(token)
+            while len(self.data) > self.size:
+                oldest = next(iter(self.data))
+                self._drop(oldest)
+                self.evictions += 1
+
+    # Invalidate a single session
+    def rem(self, token, user_id=None):
+        with self.lock:
+            entry = self.data.get(token)
+            if user_id is None and entry is not None:
+                user_id = entry[1].get("id")
+            self._drop(token)
+            if user_id is not None:
+                self.generations[user_id] = self.generations.get(user_id, 0) + 1
+
+    # Invalidate every session belonging to a user
+    def rem_user(self, user_id):
+        with self.lock:
+            for token in list(self.owners.get(user_id, ())):
+                self._drop(token)
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+
+    def _drop(self, token):
+        entry = self.data.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[1].get("id")
+        owned = self.owners.get(user_id)
+        if owned is not None:
+            owned.discard(token)
+            if not owned:
+                del self.owners[user_id]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size":len(self.data),
+                "hits":self.hits,
+                "misses":self.misses,
+                "evictions":self.evictions,
+            }
+
+    def reset(self):
+        with self.lock:
+            self.data.clear()
+            self.owners.clear()
+            # Generations stay, a lookup in flight must still see the bump
+
+    def close(self):
+        self.reset()
+        return True
+
+# Roster changes after "since", folded to the latest state of each socket
+# changes: (sid, user or None for left) oldest first
+def fold_changes(since, version, changes):
+    latest = {}
+    for sid, user in changes:
+        latest[sid] = user
+    return {
+        "since":since,
+        "version":version,
+        "joined":{ sid:user for sid, user in latest.items() if user is not None },
+        "left":[sid for sid, user in latest.items() if user is None],
+    }
+
+# Online users roster keyed by socket id
+# Every join/leave bumps the version so clients can apply deltas in order
+# and ask for a snapshot when they notice a gap. The changes of the last
+# "change_log" versions are kept too, so a client coming back with a roster
+# version (and the epoch it belongs to) gets only what changed since.
+class PresenceStore():
+    def __init__(self, store):
+        self.type = store.get("type")
+        self.change_log = store.get("change_log", 1000)
+        self.data = {}
+        self.version = 0
+        # Versions only mean something within one epoch, a new one per roster that starts empty
+        self.epoch = uuid.uuid4().hex
+        # (version, sid, user or None), oldest first
+        self.changes = deque()
+        self.lock = threading.Lock()
+
+    def connected(self):
+        return True
+
+    # Add or replace the roster entry for a socket, returns the new version
+    def join(self, sid, user_id, info):
+        with self.lock:
+            self.data[sid] = { "id":user_id, "user":info }
+            self.version += 1
+            self.record(sid, info)
+            return self.version
+
+    # Remove the roster entry for a socket, returns (version, entry) or None
+    def leave(self, sid):
+        with self.lock:
+            entry = self.data.pop(sid, None)
+            if entry is None:
+                return None
+            self.version += 1
+            self.record(sid, None)
+            return self.version, entry
+
+    # Caller holds self.lock
+    def record(self, sid, info):
+        self.changes.append((self.version, sid, info))
+        while self.changes and self.changes[0][0] <= self.version - self.change_log:
+            self.changes.popleft()
+
+    # Changes after a version, None when they are no longer all known
+    def changes_since(self, since):
+        with self.lock:
+            if since > self.version or since < self.version - self.change_log:
+                return None
+            changes = [(sid, info) for version, sid, info in self.changes if version > since]
+            return fold_changes(since, self.version, changes)
+
+    def get(self, sid):
+        with self.lock:
+            return self.data.get(sid)
+
+    def users(self):
+        with self.lock:
+            return [entry["user"] for entry in self.data.values()]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "epoch":self.epoch,
+                "version":self.version,
+                "users":{ sid:entry["user"] for sid, entry in self.data.items() },
+            }
+
+    def size(self):
+        return len(self.data)
+
+    def reset(self):
+        with self.lock:
+            self.data = {}
+            self.version += 1
+            self.epoch = uuid.uuid4().hex
+            self.changes.clear()
+
+    def close(self):
+        return True
+
+# Online users roster shared by every server process through one sqlite file
+# Same interface as PresenceStore. Rows are tagged with the process (node)
+# that owns the socket, nodes heartbeat and rows of a node that stopped
+# heartbeating are swept, so a crashed process doesn't leave ghosts online.
+# The version, epoch and change log live in the file too, so they survive
+# a restart of every process and clients resume across it.
+class SharedPresenceStore():
+    def __init__(self, store):
+        self.source = store.get("source")
+        self.type = store.get("type")
+        self.change_log = store.get("change_log", 1000)
+        self.heartbeat = store.get("heartbeat", 5)
+        self.stale_after = store.get("stale_after", 30)
+        self.node = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(local_file(self.source), timeout=5, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS presence (
+                sid TEXT PRIMARY KEY,
+                node TEXT NOT NULL,
+                user_id TEXT,
+                user TEXT
+            );
+            CREATE INDEX IF NOT EXISTS presence_node ON presence (node);
+            CREATE TABLE IF NOT EXISTS presence_nodes (
+                node TEXT PRIMARY KEY,
+                seen REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS presence_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO presence_version (id, version) VALUES (1, 0);
+            CREATE TABLE IF NOT EXISTS presence_changes (
+                version INTEGER NOT NULL,
+                sid TEXT NOT NULL,
+                user TEXT
+            );
+            CREATE INDEX IF NOT EXISTS presence_changes_version ON presence_changes (version);
+            CREATE TABLE IF NOT EXISTS presence_epoch (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                epoch TEXT NOT NULL
+            );
+        ''')
+        self.conn.execute("INSERT OR IGNORE INTO presence_epoch (id, epoch) VALUES (1, ?)", (uuid.uuid4().hex,))
+        self.conn.commit()
+        self.epoch = self.conn.execute("SELECT epoch FROM presence_epoch WHERE id=1").fetchone()[0]
+        self.beat()
+
+        self.closed = threading.Event()
+        self.sweeper = threading.Thread(target=self.run, name="presence-heartbeat", daemon=True)
+        self.sweeper.start()
+
+    def connected(self):
+        return self.conn is not None
+
+    # Run statements in one write transaction, bump and return the version if anything changed
+    # work(conn, changes) appends (sid, user json or None) for each socket it adds or removes
+    def transaction(self, work):
+        with self.lock:
+            def run():
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    changes = []
+                    result = work(self.conn, changes)
+                    version = None
+                    if result:
+                        self.conn.execute("UPDATE presence_version SET version=version+1 WHERE id=1")
+                        version = self.conn.execute("SELECT version FROM presence_version WHERE id=1").fetchone()[0]
+                        self.conn.executemany(
+                            "INSERT INTO presence_changes (version, sid, user) VALUES (?, ?, ?)",
+                            [(version, sid, user) for sid, user in changes]
+                        )
+                        self.conn.execute("DELETE FROM presence_changes WHERE version<=?", (version - self.change_log,))
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+                return version, result
+            return offload(run)
+
+    def join(self, sid, user_id, info):
+        def work(conn, changes):
+            user = json.dumps(info)
+            conn.execute(
+                "INSERT OR REPLACE INTO presence (sid, node, user_id, user) VALUES (?, ?, ?, ?)",
+                (sid, self.node, user_id, user)
+            )
+            changes.append((sid, user))
+            return True
+        version, result = self.transaction(work)
+        return version
+
+    def leave(self, sid):
+        def work(conn, changes):
+            row = conn.execute("SELECT user_id, user FROM presence WHERE sid=?", (sid,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM presence WHERE sid=?", (sid,))
+            changes.append((sid, None))
+            return { "id":row[0], "user":json.loads(row[1]) }
+        version, entry = self.transaction(work)
+        if entry is None:
+            return None
+        return version, entry
+
+    def get(self, sid):
+        with self.lock:
+            row = self.conn.execute("SELECT user_id, user FROM presence WHERE sid=?", (sid,)).fetchone()
+        if row is None:
+            return None
+        return { "id":row[0], "user":json.loads(row[1]) }
+
+    def users(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT user FROM presence").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def snapshot(self):
+        with self.lock:
+            # One read transaction so the rows match the version
+            self.conn.execute("BEGIN")
+            try:
+                version = self.conn.execute("SELECT version FROM presence_version WHERE id=1").fetchone()[0]
+                rows = self.conn.execute("SELECT sid, user FROM presence").fetchall()
+            finally:
+                self.conn.commit()
+        return {
+            "epoch":self.epoch,
+            "version":version,
+            "users":{ sid:json.loads(user) for sid, user in rows },
+        }
+
+    # Changes after a version, None when they are no longer all known
+    def changes_since(self, since):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                version = self.conn.execute("SELECT version FROM presence_version WHERE id=1").fetchone()[0]
+                if since > version or since < version - self.change_log:
+                    return None
+                rows = self.conn.execute(
+                    "SELECT sid, user FROM presence_changes WHERE version>? ORDER BY version, rowid", (since,)
+                ).fetchall()
+            finally:
+                self.conn.commit()
+        return fold_changes(since, version, [(sid, None if user is None else json.loads(user)) for sid, user in rows])
+
+    def size(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM presence").fetchone()[0]
+
+    def beat(self):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO presence_nodes (node, seen) VALUES (?, ?)", (self.node, time.time()))
+            self.conn.commit()
+
+    # Drop the rows of nodes that stopped heartbeating
+    def sweep(self):
+        def work(conn, changes):
+            stale = [row[0] for row in conn.execute(
+                "SELECT node FROM presence_nodes WHERE seen<?", (time.time() - self.stale_after,)
+            )]
+            removed = 0
+            for node in stale:
+                changes.extend((row[0], None) for row in conn.execute("SELECT sid FROM presence WHERE node=?", (node,)))
+                removed += conn.execute("DELETE FROM presence WHERE node=?", (node,)).rowcount
+                conn.execute("DELETE FROM presence_nodes WHERE node=?", (node,))
+            return removed
+        version, removed = self.transaction(work)
+        return removed
+
+    def run(self):
+        while not self.closed.wait(self.heartbeat):
+            try:
+                self.beat()
+                self.sweep()
+            except sqlite3.Error as e:
+                log.error("presence_heartbeat_failed", error=str(e))
+
+    # Remove this node's rows, the other nodes keep theirs
+    def reset(self):
+        def work(conn, changes):
+            changes.extend((row[0], None) for row in conn.execute("SELECT sid FROM presence WHERE node=?", (self.node,)))
+            return conn.execute("DELETE FROM presence WHERE node=?", (self.node,)).rowcount
+        self.transaction(work)
+
+    def close(self):
+        self.closed.set()
+        self.sweeper.join()
+        self.reset()
+        with self.lock:
+            self.conn.execute("DELETE FROM presence_nodes WHERE node=?", (self.node,))
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+# Append-only log of broadcast alerts
+# seq is the rowid, so replaying "everything after seq N" is a range scan of
+# the primary key and never touches older rows. AUTOINCREMENT keeps numbers
+# from being reused once old rows are pruned, and server processes sharing
+# the file share one sequence.
+# Targeted alerts list their rooms in alert_rooms, keyed (room, seq) so a
+# replay only reads the rooms of the reconnecting user.
+class AlertLog():
+    def __init__(self, store):
+        self.source = store.get("source")
+        self.type = store.get("type")
+        self.replay_count = store.get("replay_count", 50)
+        self.replay_age = store.get("replay_age", 86400)
+        self.keep_count = store.get("keep_count", 100000)
+        self.keep_age = store.get("keep_age", 30 * 86400)
+        self.sweep_interval = store.get("sweep_interval", 300)
+        self.sweep_batch = store.get("sweep_batch", 500)
+        self.cache_ttl = store.get("cache_ttl", 1)
+        self.query_seconds = SQLITE_SECONDS.labels("alerts")
+        self.commit_count = SQLITE_COMMITS.labels("alerts")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(local_file(self.source), timeout=5, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS alerts (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                sent_at REAL NOT NULL,
+                message TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS alerts_sent_at ON alerts (sent_at);
+            CREATE TABLE IF NOT EXISTS alert_rooms (
+                room TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                PRIMARY KEY (room, seq)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS alert_rooms_seq ON alert_rooms (seq);
+        ''')
+        columns = set(row[1] for row in self.conn.execute("PRAGMA table_info(alerts)"))
+        if "targeted" not in columns:
+            # Logs from before targeted alerts, every row is for everyone
+            self.conn.execute("ALTER TABLE alerts ADD COLUMN targeted INTEGER NOT NULL DEFAULT 0")
+        if "audio" not in columns:
+            # Key of the alert's spoken audio, see spoken()
+            self.conn.execute("ALTER TABLE alerts ADD COLUMN audio TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS alerts_audio ON alerts (audio)")
+        self.conn.commit()
+        # Replies by last seen seq, a mass reconnect mostly asks the same question
+        self.replays = {}
+        self.purged = 0
+
+        self.closed = threading.Event()
+        self.sweeper = threading.Thread(target=self.sweep, name="alert-log-sweeper", daemon=True)
+        self.sweeper.start()
+
+    def connected(self):
+        return self.conn is not None
+
+    # Store an alert sent to rooms (None for everyone), returns its sequence number
+    def append(self, message, sent_at, rooms=None):
+        encoded = json.dumps(message, separators=(",", ":"))
+        def write():
+            started = time.perf_counter()
+            try:
+                cursor = self.conn.execute(
+                    "INSERT INTO alerts (sent_at, message, targeted, audio) VALUES (?, ?, ?, ?)",
+                    (sent_at, encoded, 1 if rooms else 0, message.get("audio"))
+                )
+                seq = cursor.lastrowid
+                if rooms:
+                    self.conn.executemany("INSERT INTO alert_rooms (room, seq) VALUES (?, ?)", [(room, seq) for room in rooms])
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            self.query_seconds.record(time.perf_counter() - started)
+            self.commit_count.inc()
+            return seq
+        with self.lock:
+            seq = offload(write)
+            self.replays = {}
+        return seq
+
+    def head(self):
+        with self.lock:
+            return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM alerts").fetchone()[0]
+
+    # Newest alert sent with a spoken audio key, None if there is none
+    def spoken(self, audio):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT message FROM alerts WHERE audio=? ORDER BY seq DESC LIMIT 1", (audio,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    # Alerts after last_seq for a user in rooms, at most replay_count of the
+    # newest and none older than replay_age
+    def replay(self, last_seq, rooms=()):
+        rooms = tuple(sorted(rooms))
+        key = (last_seq, rooms)
+        now = time.monotonic()
+        with self.lock:
+            cached = self.replays.get(key)
+            if cached is not None and now - cached[0] < self.cache_ttl:
+                return cached[1]
+            started = time.perf_counter()
+            placeholders = ", ".join("?" for room in rooms)
+            rows = self.conn.execute(f'''
+                SELECT seq, sent_at, message FROM alerts
+                WHERE seq>? AND sent_at>=? AND (
+                    targeted=0 OR seq IN (SELECT seq FROM alert_rooms WHERE room IN ({placeholders}) AND seq>?)
+                )
+                ORDER BY seq DESC LIMIT ?
+            ''', (last_seq, time.time() - self.replay_age, *rooms, last_seq, self.replay_count + 1)).fetchall()
+            head = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM alerts").fetchone()[0]
+            self.query_seconds.record(time.perf_counter() - started)
+        alerts = []
+        for seq, sent_at, message in reversed(rows[:self.replay_count]):
+            alert = json.loads(message)
+            alert["seq"] = seq
+            alert["sent_at"] = sent_at
+            alerts.append(alert)
+        result = {
+            "alerts":alerts,
+            # Newest seq, also resets clients that remember a seq from a log since cleared
+            "last_seq":head,
+            "truncated":len(rows) > self.replay_count,
+        }
+        with self.lock:
+            if len(self.replays) >= 1000:
+                self.replays = {}
+            self.replays[key] = (now, result)
+        return result
+
+    # Delete rows past the retention limits one batch per transaction
+    def purge(self):
+        total = 0
+        while not self.closed.is_set():
+            def work():
+                cursor = self.conn.execute('''
+                    DELETE FROM alerts WHERE seq IN (
+                        SELECT seq FROM alerts WHERE seq<=(SELECT MAX(seq) FROM alerts)-? OR sent_at<? LIMIT ?
+                    )
+                ''', (self.keep_count, time.time() - self.keep_age, self.sweep_batch))
+                self.conn.execute(
+                    "DELETE FROM alert_rooms WHERE seq<COALESCE((SELECT MIN(seq) FROM alerts), 9223372036854775807)"
+                )
+                self.conn.commit()
+                return cursor.rowcount
+            with self.lock:
+                removed = offload(work)
+            total += removed
+            if removed < self.sweep_batch:
+                break
+        self.purged += total
+        return total
+
+    def sweep(self):
+        while not self.closed.wait(self.sweep_interval):
+            try:
+                self.purge()
+            except sqlite3.Error as e:
+                log.error("alert_log_purge_failed", error=str(e))
+
+    def size(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM alerts").fetchone()[0]
+
+    def reset(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM alerts")
+            self.conn.execute("DELETE FROM alert_rooms")
+            self.conn.commit()
+            self.replays = {}
+
+    def close(self):
+        self.closed.set()
+        self.sweeper.join()
+        with self.lock:
+            self.conn.close()
+            self.conn = None
+
+# Alert catalog for admin consoles, read from the data store
+# Sorted by sort_index and json encoded once per version, the version is a
+# hash of the content so consoles can tell whether their cached copy is current
+class AlertCatalog():
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        alerts = sorted(self.store.get("alerts") or [], key=lambda alert: alert.get("sort_index") or 0)
+        encoded_alerts = json.dumps(alerts, separators=(",", ":"))
+        version = hashlib.sha1(encoded_alerts.encode("utf-8")).hexdigest()[:16]
+        with self.lock:
+            self.alerts = alerts
+            self.version = version
+            self.encoded = '{"version":"'+version+'","alerts":'+encoded_alerts+'}'
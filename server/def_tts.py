@@ -0,0 +1,177 @@
+import io
+import math
+import wave
+import struct
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from def_logging import get_logger
+
+log = get_logger("tts")
+
+# Spoken alerts rendered once on the server
+# Each alert's spoken text is keyed by a hash of backend, language and text,
+# the audio is rendered on first request and kept in an LRU cache, clients
+# fetch it with GET /tts/<key> and keep their own copy by the same key.
+# Only keys handed out with an alert are rendered, a process that didn't
+# hand a key out finds its text with "lookup" (the shared alert log).
+# Concurrent requests for a key that is still rendering wait for that one
+# render instead of starting their own.
+
+# Online synthesis with Google Translate's TTS (pip install gtts)
+class GttsBackend():
+    name = "gtts"
+    mimetype = "audio/mpeg"
+
+    def __init__(self, options):
+        from gtts import gTTS
+        self.gTTS = gTTS
+        self.lang = options.get("lang", "en")
+
+    def render(self, text):
+        audio = io.BytesIO()
+        self.gTTS(text, lang=self.lang).write_to_fp(audio)
+        return audio.getvalue()
+
+# Offline stand-in - a short WAV chime whose pitches are derived from the
+# text, so different alerts still sound different. No network, no extra
+# packages, deterministic output for tests and air-gapped sites.
+class ToneBackend():
+    name = "tone"
+    mimetype = "audio/wav"
+    RATE = 16000
+
+    def __init__(self, options):
+        self.lang = options.get("lang", "en")
+        self.note_seconds = options.get("note_seconds", 0.15)
+
+    def render(self, text):
+        digest = hashlib.sha1(text.encode("utf-8")).digest()
+        samples = []
+        for byte in digest[:4]:
+            frequency = 440 * 2 ** ((byte % 24) / 12)
+            count = int(self.RATE * self.note_seconds)
+            for n in range(count):
+                # Short fade in and out so notes don't click
+                envelope = min(1, n / 200, (count - n) / 200)
+                samples.append(int(12000 * envelope * math.sin(2 * math.pi * frequency * n / self.RATE)))
+        audio = io.BytesIO()
+        with wave.open(audio, "wb") as output:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(self.RATE)
+            output.writeframes(struct.pack("<"+str(len(samples))+"h", *samples))
+        return audio.getvalue()
+
+BACKENDS = { "gtts":GttsBackend, "tone":ToneBackend }
+
+class TtsCache():
+    # lookup(key) -> spoken text of an alert sent with that key, or None
+    def __init__(self, options, lookup=None):
+        self.lookup = lookup
+        backend = options.get("backend", "gtts")
+        if backend not in BACKENDS:
+            raise ValueError("Unknown TTS backend "+backend)
+        self.backend = BACKENDS[backend](options)
+        self.max_entries = options.get("cache_entries", 500)
+        self.max_bytes = options.get("cache_bytes", 50000000)
+        self.timeout = options.get("render_timeout", 15)
+        self.lock = threading.Lock()
+        # key -> audio bytes, least recently used first
+        self.audio = OrderedDict()
+        self.bytes = 0
+        # key -> text for keys handed out, so a render can happen on first fetch
+        self.texts = OrderedDict()
+        # key -> Event set when the render in flight finishes
+        self.rendering = {}
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+        self.failures = 0
+
+    def key(self, text):
+        return hashlib.sha1((self.backend.name+"\0"+self.backend.lang+"\0"+text).encode("utf-8")).hexdigest()[:20]
+
+    # Key for a text, remembered so GET /tts/<key> can render it
+    def remember(self, text):
+        key = self.key(text)
+        with self.lock:
+            self.texts[key] = text
+            self.texts.move_to_end(key)
+            while len(self.texts) > self.max_entries * 4:
+                self.texts.popitem(last=False)
+        return key
+
+    # Audio for a key, rendering it (once) if needed
+    # None for keys no alert was sent with, or when rendering failed
+    def get(self, key):
+        with self.lock:
+            known = key in self.audio or key in self.texts
+        if not known and self.lookup is not None:
+            # Handed out by another server process
+            text = self.lookup(key)
+            if text is not None and self.key(text) == key:
+                self.remember(text)
+        while True:
+            with self.lock:
+                audio = self.audio.get(key)
+                if audio is not None:
+                    self.audio.move_to_end(key)
+                    self.hits += 1
+                    return audio
+                text = self.texts.get(key)
+                if text is None:
+                    return None
+                pending = self.rendering.get(key)
+                if pending is None:
+                    pending = self.rendering[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Someone else is rendering it, wait and look again
+            if not pending.wait(self.timeout):
+                return None
+            with self.lock:
+                if key not in self.audio:
+                    return None
+
+        audio = None
+        try:
+            audio = self.backend.render(text)
+        except Exception as e:
+            log.error("tts_render_failed", key=key, backend=self.backend.name, error=repr(e))
+            with self.lock:
+                self.failures += 1
+        finally:
+            with self.lock:
+                if audio is not None:
+                    self.store(key, audio)
+                    self.renders += 1
+                del self.rendering[key]
+            pending.set()
+        return audio
+
+    # Render ahead of the first fetch
+    def prefetch(self, key):
+        self.get(key)
+
+    # Caller holds self.lock
+    def store(self, key, audio):
+        self.audio[key] = audio
+        self.bytes += len(audio)
+        while self.audio and (len(self.audio) > self.max_entries or self.bytes > self.max_bytes):
+            evicted_key, evicted = self.audio.popitem(last=False)
+            self.bytes -= len(evicted)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend":self.backend.name,
+                "entries":len(self.audio),
+                "bytes":self.bytes,
+                "hits":self.hits,
+                "misses":self.misses,
+                "renders":self.renders,
+                "failures":self.failures,
+            }
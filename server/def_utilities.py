@@ -2,6 +2,8 @@ import sys
 import os
 import json
 
+from datetime import datetime, timezone
+
 # Return filename prefixed with client path
 def local_file(filename):
     # If the application is run as a bundle, the PyInstaller bootloader
@@ -19,3 +21,27 @@ def read_json(filename):
         config = json.load(f)
     return config
 
+# Return the current UTC time as an ISO 8601 string
+def timestamp():
+    return datetime.now(timezone.utc).isoformat()
+
+# Blocking calls (bcrypt, sqlite commits, fsync) go through offload() so a
+# green thread server (eventlet/gevent) can run them on real OS threads
+# instead of stalling every other connection
+offload_to = None
+
+def set_async_mode(mode):
+    global offload_to
+    if mode == "eventlet":
+        from eventlet import tpool
+        offload_to = tpool.execute
+    elif mode == "gevent":
+        import gevent
+        offload_to = lambda fn, *args: gevent.get_hub().threadpool.apply(fn, args)
+    else:
+        offload_to = None
+
+def offload(fn, *args):
+    if offload_to is None:
+        return fn(*args)
+    return offload_to(fn, *args)
@@ -0,0 +1,136 @@
+import threading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Wire encodings for the busy server -> client events
+# JSON stays the default. A client that offers "msgpack" in validate gets
+# alerts, roster and presence events as MessagePack bytes with short field
+# tags instead of repeated key names. Broadcasts are encoded once per
+# encoding, not per client - each encoding has its own copy of every room
+# ("role:2" for JSON clients, "role:2@msgpack" for MessagePack ones).
+
+# Field name -> tag, keep in step with the client's copy
+FIELD_TAGS = {
+    "username":"u",
+    "text":"t",
+    "color":"c",
+    "seq":"s",
+    "sent_at":"at",
+    "audio":"a",
+    "repeat":"r",
+    "version":"v",
+    "id":"i",
+    "user":"U",
+    "users":"us",
+    "name":"n",
+    "icon":"ic",
+    "role":"ro",
+    "group":"g",
+    "since":"si",
+    "joined":"j",
+    "left":"l",
+    "epoch":"e",
+    "alerts":"al",
+    "last_seq":"ls",
+    "truncated":"tr",
+}
+TAG_FIELDS = { tag:field for field, tag in FIELD_TAGS.items() }
+
+# Room every validated connection joins, for events sent to everyone
+EVERYONE_ROOM = "everyone"
+
+CONTAINERS = (dict, list, tuple)
+
+# Only containers are recursed into, a call per scalar would double the roster's encode time
+def tag_fields(data):
+    if isinstance(data, dict):
+        return { FIELD_TAGS.get(key, key):tag_fields(value) if isinstance(value, CONTAINERS) else value for key, value in data.items() }
+    return [tag_fields(value) if isinstance(value, CONTAINERS) else value for value in data]
+
+def untag_fields(data):
+    if isinstance(data, dict):
+        return { TAG_FIELDS.get(key, key):untag_fields(value) if isinstance(value, CONTAINERS) else value for key, value in data.items() }
+    return [untag_fields(value) if isinstance(value, CONTAINERS) else value for value in data]
+
+# Socket.IO serializes dicts to JSON itself
+class JsonEncoding():
+    name = "json"
+
+    def encode(self, data):
+        return data
+
+    def decode(self, data):
+        return data
+
+# MessagePack with tagged fields (pip install msgpack)
+class MsgpackEncoding():
+    name = "msgpack"
+
+    def encode(self, data):
+        return msgpack.packb(tag_fields(data) if isinstance(data, CONTAINERS) else data, use_bin_type=True)
+
+    def decode(self, data):
+        data = msgpack.unpackb(data, raw=False)
+        return untag_fields(data) if isinstance(data, CONTAINERS) else data
+
+# Encodings this process can speak
+def available_encodings():
+    encodings = { "json":JsonEncoding() }
+    if msgpack is not None:
+        encodings["msgpack"] = MsgpackEncoding()
+    return encodings
+
+# Encoding chosen for each connection
+# shared=True for nodes behind a message queue - a broadcast from here also
+# reaches other nodes' clients and goes out in this node's encodings only, so
+# every node needs the same "encodings" and can't skip one it lacks
+class Wire():
+    def __init__(self, options, shared=False):
+        available = available_encodings()
+        self.encodings = { "json":available["json"] }
+        for name in options.get("encodings", ["json"]):
+            if name in available:
+                self.encodings[name] = available[name]
+            elif shared:
+                raise RuntimeError("Wire encoding "+str(name)+" is configured but unavailable (pip install msgpack)")
+        # sid -> encoding name, JSON connections aren't listed
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    # First encoding offered that this server speaks, JSON if none (or none offered)
+    def negotiate(self, sid, offered):
+        name = "json"
+        for candidate in offered or []:
+            if candidate in self.encodings:
+                name = candidate
+                break
+        with self.lock:
+            if name == "json":
+                self.clients.pop(sid, None)
+            else:
+                self.clients[sid] = name
+        return name
+
+    def encoding(self, sid):
+        with self.lock:
+            return self.clients.get(sid, "json")
+
+    def forget(self, sid):
+        with self.lock:
+            self.clients.pop(sid, None)
+
+    def encode(self, name, data):
+        return self.encodings[name].encode(data)
+
+    # A room's copy for an encoding
+    def room(self, room, name):
+        if name == "json":
+            return room
+        return room+"@"+name
+
+    # Encodings broadcasts are sent in
+    def names(self):
+        return list(self.encodings.keys())
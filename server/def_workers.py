@@ -0,0 +1,134 @@
+import time
+import threading
+import bcrypt
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+
+from def_utilities import offload
+from def_metrics import BCRYPT_SECONDS
+
+# Hash a password with a fresh salt
+# NOTE: Module level so it can be pickled into a process pool
+def hash_password(password):
+    password = password.encode('utf-8')  # Passwords should be bytes
+    salt = bcrypt.gensalt()  # Generate a random salt
+    return bcrypt.hashpw(password, salt)  # Hash the password
+
+# Check a password against a stored hash
+def check_password(password, hashed):
+    if password is None or hashed is None:
+        return False
+    if isinstance(hashed, str):
+        hashed = hashed.encode('utf-8')
+    return bcrypt.checkpw(password.encode('utf-8'), hashed)
+
+# Run a job and time it where it runs, so time waiting in the queue isn't counted
+def timed_job(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+# Raised when the pool queue is full or a job took too long
+# Handlers answer with a "busy" response instead of waiting
+class PoolBusy(Exception):
+    pass
+
+# Bounded worker pool for bcrypt work
+# Keeps password hashing off the socket/request threads and caps how much
+# CPU a login storm can take away from alert broadcasts
+class HashPool():
+    def __init__(self, pool, async_mode="threading"):
+        self.type = pool.get("type", "thread")
+        self.workers = pool.get("workers", 2)
+        self.queue = pool.get("queue", 32)
+        self.timeout = pool.get("timeout", 10)
+        self.executor = None
+        self.running = None
+        if self.type == "process":
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        elif self.type == "thread" and async_mode in ("eventlet", "gevent"):
+            # Pool threads would be green threads here and bcrypt would block
+            # the hub, hand the work to the hub's OS thread pool instead
+            self.running = threading.BoundedSemaphore(self.workers)
+        elif self.type == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        # "inline" runs on the calling thread, no pool
+        # One slot per running or queued job
+        self.slots = threading.BoundedSemaphore(self.workers + self.queue)
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.rejected = 0
+
+    def run(self, fn, *args):
+        elapsed, result = self.dispatch(timed_job, fn, *args)
+        BCRYPT_SECONDS.labels(fn.__name__).record(elapsed)
+        return result
+
+    def dispatch(self, fn, *args):
+        if self.type == "inline":
+            return fn(*args)
+
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise PoolBusy()
+
+        if self.running is not None:
+            return self.run_offloaded(fn, *args)
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(self._done)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            with self.lock:
+                self.rejected += 1
+            raise PoolBusy()
+
+    def _done(self, future):
+        self.slots.release()
+        with self.lock:
+            self.completed += 1
+
+    # Green thread servers - wait for one of "workers" turns, then run on an OS thread
+    def run_offloaded(self, fn, *args):
+        try:
+            if not self.running.acquire(timeout=self.timeout):
+                with self.lock:
+                    self.rejected += 1
+                raise PoolBusy()
+            try:
+                result = offload(fn, *args)
+            finally:
+                self.running.release()
+        finally:
+            self.slots.release()
+        with self.lock:
+            self.completed += 1
+        return result
+
+    def hash(self, password):
+        return self.run(hash_password, password)
+
+    def check(self, password, hashed):
+        return self.run(check_password, password, hashed)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "type":self.type,
+                "workers":self.workers,
+                "queue":self.queue,
+                "completed":self.completed,
+                "rejected":self.rejected,
+            }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        return True
@@ -0,0 +1,87 @@
+import time
+import asyncio
+import argparse
+import urllib.parse
+import urllib.request
+import json
+
+import socketio
+
+# Load test: hold thousands of idle websocket connections against one server
+# process and report how many stayed connected, handshake times and (with
+# --pid, on Linux) the server's memory and OS thread count.
+#
+# Run the server with "ASYNC_MODE":"eventlet" or "gevent" in config.json to
+# compare with the default "threading" mode, which needs one OS thread per
+# connection.
+#
+# Usage: python load_test.py --clients 5000 --user user1 --password password1 --pid <server pid>
+
+def login(url, user_id, password):
+    data = urllib.parse.urlencode({ "user_id":user_id, "password":password }).encode()
+    with urllib.request.urlopen(f"{url}/login", data=data, timeout=30) as response:
+        return json.loads(response.read()).get("token")
+
+def server_stats(pid):
+    stats = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "Threads"):
+                stats[key] = value.strip()
+    return stats
+
+async def open_client(url, token, validate, handshakes, results):
+    client = socketio.AsyncClient(reconnection=False)
+    async with handshakes:
+        started = time.perf_counter()
+        try:
+            await client.connect(url, transports=["websocket"])
+            if validate:
+                await client.emit("validate", { "token":token, "presence":None })
+        except Exception as e:
+            results["failed"] += 1
+            results["errors"].add(str(e))
+            return None
+        results["connect_times"].append(time.perf_counter() - started)
+    return client
+
+async def main(args):
+    token = login(args.url, args.user, args.password) if args.user else None
+    handshakes = asyncio.Semaphore(args.concurrency)
+    results = { "failed":0, "errors":set(), "connect_times":[] }
+
+    started = time.perf_counter()
+    clients = await asyncio.gather(*[
+        open_client(args.url, token, args.validate, handshakes, results)
+        for n in range(args.clients)
+    ])
+    elapsed = time.perf_counter() - started
+    clients = [client for client in clients if client is not None]
+
+    times = sorted(results["connect_times"]) or [0]
+    print(f"connected {len(clients)}/{args.clients} in {elapsed:.1f}s, failed {results['failed']}")
+    print(f"handshake p50 {times[len(times)//2]*1000:.1f}ms  p99 {times[int(len(times)*0.99)-1]*1000:.1f}ms  max {times[-1]*1000:.1f}ms")
+    for error in list(results["errors"])[:5]:
+        print(f"  error: {error}")
+
+    # Hold the connections idle, then check how many survived
+    await asyncio.sleep(args.hold)
+    alive = sum(1 for client in clients if client.connected)
+    print(f"still connected after {args.hold}s idle: {alive}")
+    if args.pid:
+        print(f"server process: {server_stats(args.pid)}")
+
+    await asyncio.gather(*[client.disconnect() for client in clients], return_exceptions=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Idle connection load test")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200, help="handshakes in flight at once")
+    parser.add_argument("--hold", type=float, default=30, help="seconds to hold the connections open")
+    parser.add_argument("--user", help="login to get a session token")
+    parser.add_argument("--password")
+    parser.add_argument("--validate", action="store_true", help="validate each connection (joins the online users roster)")
+    parser.add_argument("--pid", type=int, help="server process id, to report its memory and threads")
+    asyncio.run(main(parser.parse_args()))